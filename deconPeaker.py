@@ -37,19 +37,20 @@ def preprocess():
 
     '''
     LOGS.info('Loading peaks......')
-    merged_files = mp_read_peaks(ARGS.infos.PEAK.values.tolist(), kargs=ARGS)
+    peak_tables = mp_read_peaks(ARGS.infos.PEAK.values.tolist(), kargs=ARGS)
     
     LOGS.info('Chosing a list of non-overlapping, maximally significant peaks')
     nonovp_peakfil = remove_redundant_peakfile(
-            merged_files              , 
+            peak_tables               , 
             ARGS.infos.CELL.unique()  , 
             ARGS.prefix               , 
-            ARGS.outdir
+            ARGS.outdir               ,
+            threads = ARGS.thread
         )
     
     if ARGS.offset:
         LOGS.info('Filtering out the peaks nearby the TSS (+/-{} bps)'.format(ARGS.offset))
-    nonovp_peakfil = remove_peaks_nearbytss(nonovp_peakfil, ARGS.hg_genome, offset=ARGS.offset)
+    nonovp_peakfil = remove_peaks_nearbytss(nonovp_peakfil, ARGS.hg_genome, offset=ARGS.offset, cache_dir=ARGS.cache_dir)
     
     peaknum = get_line_number(nonovp_peakfil)
     LOGS.info('Counting the number of fragments from each sample falling into each of {} peaks'.format(peaknum))
@@ -73,27 +74,45 @@ def findctsps():
     :return: 0
 
     '''
-    profile    = load_profile(ARGS.profile, ARGS.lib_strategy)
-    phenotypes = load_phenotypes(ARGS.phenotype)
-    LOGS.info('Loaded {} peaks and {} samples'.format(profile.shape[0], profile.shape[1] - 3))
-
-    ARGS.prefix = os.path.basename(ARGS.profile).rsplit('.', 1)[0]
-    LOGS.info('Normalizing pure profile by {} method to remove batch effects'.format(ARGS.norm))
-    profile_norm = normalize_profile(
-            profile              , 
-            ARGS.norm            , 
-            profile.columns[3 : ],
-            False                
-        )
+    phenotypes  = load_phenotypes(ARGS.phenotype)
+    ARGS.prefix = os.path.basename(ARGS.profile.rstrip(os.sep)).rsplit('.', 1)[0]
+    if ARGS.chunk_size:
+        LOGS.info('Identifying cell specific peaks out of core in blocks of {} peaks'.format(ARGS.chunk_size))
+        markerpeaks = chunked_cellspecificpeaks(ARGS.profile, phenotypes, ARGS)
+        LOGS.info('Final number of cell specific peaks is {}'.format(markerpeaks.shape[0]))
+        return 0
     
-    profile_norm = filter_weakpeaks(profile_norm)
-    curcnts, diffcnts = profile_norm.shape[0], profile.shape[0] - profile_norm.shape[0]
-    LOGS.info('Filtering out {} peaks and {} peaks have been remained'.format(diffcnts, curcnts))
-    del profile
-
-    LOGS.info('Identifying cell specific peaks accross pure cell profile')
-    markerpeaks = cellspecificpeaks(profile_norm, phenotypes, ARGS)
-
+    key = cache_key('markers', file_checksum(ARGS.profile), file_checksum(ARGS.phenotype), ARGS.lib_strategy, ARGS.norm, \
+            ARGS.dtype, ARGS.merge_replicates) if ARGS.cache_dir else None
+    markers = cache_load(ARGS.cache_dir, key)
+    if markers is None:
+        profile = load_profile(ARGS.profile, ARGS.lib_strategy, dtype=ARGS.dtype)
+        LOGS.info('Loaded {} peaks and {} samples'.format(profile.shape[0], profile.shape[1] - 3))
+
+        LOGS.info('Normalizing pure profile by {} method to remove batch effects'.format(ARGS.norm))
+        profile_norm = normalize_profile(
+                profile              , 
+                ARGS.norm            , 
+                profile.columns[3 : ],
+                False                ,
+                threads = ARGS.thread,
+                dtype = ARGS.dtype
+            )
+        
+        profile_norm = filter_weakpeaks(profile_norm)
+        curcnts, diffcnts = profile_norm.shape[0], profile.shape[0] - profile_norm.shape[0]
+        LOGS.info('Filtering out {} peaks and {} peaks have been remained'.format(diffcnts, curcnts))
+        del profile
+
+        LOGS.info('Identifying cell specific peaks accross pure cell profile')
+        markers = marker_qvalues(profile_norm, phenotypes, ARGS.thread, ARGS.merge_replicates)
+        del profile_norm
+        cache_save(ARGS.cache_dir, key, markers)
+        evict_cache(ARGS.cache_dir, ARGS.cache_size)
+    else:
+        LOGS.info('Normalized profile and q-values of cell specific peaks are reused from cache')
+    
+    markerpeaks = cellspecificpeaks(markers[0], phenotypes, ARGS, qvalues=markers[1])
     LOGS.info('Final number of cell specific peaks is {}'.format(markerpeaks.shape[0]))
     return 0
 
@@ -113,17 +132,25 @@ def deconvolution():
             outdir = ARGS.outdir           ,
             bg = False
         )
-    mixsamples, sigprofile = load_profile([ARGS.mixture, ARGS.pure], ARGS.lib_strategy)
-    LOGS.info('Deconvolving......')
-    results = deconvcells(
-            mixsamples       , 
-            sigprofile       , 
-            ARGS.lib_strategy,
-            ARGS.pvalue      ,
-            ARGS.method      ,
-            ARGS.norm        ,
-            ARGS.outdir      
-        )
+    if ARGS.chunk_size:
+        LOGS.info('Deconvolving in chunks of {} mixed samples......'.format(ARGS.chunk_size))
+        results = streamed_deconvcells(ARGS.mixture, load_profile(ARGS.pure, ARGS.lib_strategy), ARGS)
+    else:
+        mixsamples, sigprofile = load_profile([ARGS.mixture, ARGS.pure], ARGS.lib_strategy)
+        LOGS.info('Deconvolving......')
+        results = deconvcells(
+                mixsamples       , 
+                sigprofile       , 
+                ARGS.lib_strategy,
+                ARGS.pvalue      ,
+                ARGS.method      ,
+                ARGS.norm        ,
+                ARGS.outdir      ,
+                ARGS.iterations  ,
+                ARGS.seed        ,
+                ARGS.early_stop  ,
+                ARGS.thread
+            )
     LOGS.info('Showing deconPeaker results: ')
     print(results)
     return 0
@@ -145,16 +172,26 @@ def simulate():
     LOGS.info('Okay!')
     return 0
 
+def convert():
+    '''
+    convert tab-separated profiles into binary columnar format
+    
+    '''
+    for fil in ARGS.profile:
+        outfile = convert_profile(fil, ARGS.outdir, ARGS.lib_strategy)
+        LOGS.info('Converted {} into {}'.format(fil, outfile))
+    return 0
+
 def run():
     '''
-    deconPeaker main funcion and contains four sections, pureprofile, identifycells, deconvolution and simulation, respectivly
+    deconPeaker main funcion and contains five sections, pureprofile, identifycells, deconvolution, simulation and convert, respectivly
     :return: stat [int] 
 
     '''
     global ARGS
     ARGS, start  = parse_opts(), time()
-    funcs, modes = [preprocess, findctsps, deconvolution, simulate], \
-                   ['preprocess', 'findctsps', 'deconvolution', 'simulation']
+    funcs, modes = [preprocess, findctsps, deconvolution, simulate, convert], \
+                   ['preprocess', 'findctsps', 'deconvolution', 'simulation', 'convert']
     ARGS.tmpdir = tmpdir = __import__('tempfile').mkdtemp('_deconPeaker')
     try:    
         stat = funcs[modes.index(ARGS.sub_parser)]()
@@ -14,7 +14,7 @@ import subprocess
 #-----------------------------------------------------
 # load own modules
 
-from modules.utils import *
+from modules.cache import *
 
 #-----------------------------------------------------
 # global setting
@@ -31,26 +31,23 @@ LOGS = log_infos()
 def convert_saf(bedfil, fg=True, upstream=500000, downstream=500000):
     '''
     convert bed to SAF format
-    :param bedfil: [str/file] bed format file
+    :param bedfil: [str/file] bed format file or binary columnar profile of peaks, read by load_regions
     :param fg: [bool] compute foreground readcounts of cells or background, default: True
     :param upstream: [int] upstream of the peaks, default: 500000
     :param downstream: [int] downstream of the peaks, default: 500000
     :return: SAF file path
     
     '''
-    suffix = '_foreground.saf' if fg else '_background.saf'
-    safile = create_tmp_files(os.path.basename(bedfil) + suffix, fixnames=True)[0]
-    with open(bedfil, 'rb') as fp_r:
-        for line in fp_r:
-            chrom, start, end = line.decode().strip().split('\t')[0 : 3]
-            if chrom == 'chrom': continue
-            start, end = map(int, [start, end])
-            if not fg:
-                start = 1 if start - upstream < 0 else start - upstream
-                end  += downstream
-            start, end = map(str, [start, end])
-            label = chrom + '.' + start + '.' + end
-            safile.write('\t'.join([label, chrom, start, end, '.']) + '\n')
+    suffix  = '_foreground.saf' if fg else '_background.saf'
+    safile  = create_tmp_files(os.path.basename(os.path.normpath(bedfil)) + suffix, fixnames=True)[0]
+    regions = load_regions(bedfil)
+    for chrom, start, end in zip(regions['chrom'], regions['start'], regions['end']):
+        if not fg:
+            start = 1 if start - upstream < 0 else start - upstream
+            end  += downstream
+        start, end = map(str, [start, end])
+        label = chrom + '.' + start + '.' + end
+        safile.write('\t'.join([label, chrom, start, end, '.']) + '\n')
     safile.close()
     return safile.name
 
@@ -69,6 +66,23 @@ def multi_get_reads(bamfils, bedfil, kargs, prefix='pure_cells_readcounts', outd
     0 if os.path.exists(outdir) else os.mkdir(outdir)
     read_counts_fil = os.path.join(outdir, prefix + '_profile.xls')
     
+    if kargs.cache_dir:
+        return cached_get_reads(bamfils, bedfil, kargs, read_counts_fil, bg=bg)
+
+    if kargs.counter == 'pysam':
+        regions = load_regions(bedfil)
+        LOGS.info('Computing {} counts of peaks for all samples by pysam......'.format('foreground/background' if bg else 'foreground'))
+        fg_counts, bg_counts = native_get_reads(bamfils, regions, kargs, bg=bg)
+        LOGS.info('Writing pure samples profile into {}'.format(read_counts_fil))
+        return write_counts_matrix(
+                regions                              ,
+                fg_counts                            ,
+                bg_counts                            ,
+                kargs.infos['CELL'].values.tolist()  ,
+                read_counts_fil                      ,
+                fmt = kargs.out_format
+            )
+
     safile_fg, safile_bg = convert_saf(bedfil, fg=True), convert_saf(bedfil, fg=False)
     cntfiles, bams_join  = [], ' '.join(bamfils)
     
@@ -87,40 +101,201 @@ def multi_get_reads(bamfils, bedfil, kargs, prefix='pure_cells_readcounts', outd
         cntfiles.append(cntfile)
     
     LOGS.info('Writing pure samples profile into {}'.format(read_counts_fil))
-    readcounts_matrix(cntfiles, kargs.infos['CELL'].values.tolist(), read_counts_fil)
-    return read_counts_fil
+    return readcounts_matrix(cntfiles, kargs.infos['CELL'].values.tolist(), read_counts_fil, fmt=kargs.out_format)
 
-def readcounts_matrix(count_files, cells, outfile, bak_offset=500000):
+def cached_get_reads(bamfils, bedfil, kargs, outfile, bg=True):
+    '''
+    reuse cached read counts of unchanged BAMs, so only new or changed samples are counted
+    :param bamfils: [list] bam files
+    :param bedfil: [str/file] non-redundant peak list file
+    :param kargs: [dict] input parameters by users, including cache_dir and cache_size
+    :param outfile: [str/file path] output file
+    :param bg: [bool] extract background read counts or not, default: True
+    :return: path of the written profile
+    
+    '''
+    regions = load_regions(bedfil)
+    peakset = frame_checksum(regions)
+    keys    = [ cache_key('counts', file_signature(bam), kargs.mapq, kargs.counter, bg, peakset) for bam in bamfils ]
+    values  = [ cache_load(kargs.cache_dir, key) for key in keys ]
+    todo    = [ idx for idx, vals in enumerate(values) if vals is None ]
+    LOGS.info('Read counts of {} samples are reused from cache'.format(len(bamfils) - len(todo)))
+    
+    if todo:
+        sub_kargs = __import__('copy').copy(kargs)
+        sub_kargs.cache_dir, sub_kargs.infos, sub_kargs.out_format = None, kargs.infos.iloc[todo], 'BINARY'
+        subfile = multi_get_reads(
+                [ bamfils[idx] for idx in todo ],
+                bedfil                          ,
+                sub_kargs                       ,
+                prefix = 'uncached_readcounts'  ,
+                outdir = mk_dir(kargs.tmpdir, 'readcounts'),
+                bg = bg
+            )
+        counts = np.array(read_binary_profile(subfile).iloc[:, 3 : ].values)
+        for pos, idx in enumerate(todo):
+            values[idx] = counts[:, pos]
+            cache_save(kargs.cache_dir, keys[idx], values[idx])
+        __import__('shutil').rmtree(subfile)
+    
+    evict_cache(kargs.cache_dir, kargs.cache_size)
+    cells = kargs.infos['CELL'].values.tolist()
+    return write_counts_matrix(regions, np.column_stack(values), None, cells, outfile, fmt=kargs.out_format)
+
+def load_featurecounts(cntfile):
+    '''
+    bulk load a featureCounts output file
+    :param cntfile: [str/file] featureCounts output, a program line and a header line precede the counts
+    :return: regions [pd.DataFrame] chromosome, start and end of peaks; counts [np.array] int64 peaks x samples
+    
+    '''
+    table   = pd.read_csv(cntfile, sep='\t', header=None, skiprows=2, dtype={1 : str})
+    regions = table.iloc[:, 1 : 4]
+    regions.columns = ['chrom', 'start', 'end']
+    return regions, table.iloc[:, 6 : ].values.astype(np.int64)
+
+def readcounts_matrix(count_files, cells, outfile, bak_offset=500000, fmt='TABLE'):
     '''
     convert read counts of peaks to matrix for total samples
-    :param count_files: [str/files] read counts file of all samples
+    :param count_files: [str/files] read counts file of all samples, foreground and optional background
     :param cells: [list] cell or mixed sample names 
     :param outfile: [str/file path] output file
     :param bak_offset: [int] offset distance around summit to compute background read counts, default: 500000
-    :return: 0
+    :param fmt: [str] output format, TABLE or BINARY, default: TABLE
+    :return: path of the written profile
     
     '''
     count_files = count_files if isinstance(count_files, list) else [ count_files ]
-    fps = [ open(fil, 'rb') for fil in count_files ]
-    [ fp.readline() for fp in fps for idx in range(2) ]
-    with open(outfile, 'w') as fp_w:
-        fp_w.write('chrom\tstart\tend\t{}\n'.format('\t'.join(cells)))
-        if len(count_files) > 1:
-            while 1:
-                for_cnts, bak_cnts = [fp.readline().split('\t') for fp in fps]
-                if not for_cnts[0]: break
-                tmp_infos  = for_cnts[1 : 4]
-                cnt1, cnt2 = map(int, for_cnts[6 : ]), map(int, bak_cnts[6 : ])
-                sig_ratio  = np.array(cnt1) / np.array(cnt2).astype(float) * bak_offset * 2 / 500.0
-                sig_ratio  = np.around(sig_ratio, 3).tolist()
-                tmp_infos += map(str, sig_ratio)
-                fp_w.write('\t'.join(tmp_infos) + '\n')
+    regions, fg_counts = load_featurecounts(count_files[0])
+    bg_counts = load_featurecounts(count_files[1])[1] if len(count_files) > 1 else None
+    return write_counts_matrix(regions, fg_counts, bg_counts, cells, outfile, bak_offset=bak_offset, fmt=fmt)
+
+def load_regions(bedfil):
+    '''
+    load chromosome, start and end of peaks, in the same order as the SAF file written by convert_saf
+    :param bedfil: [str/file] bed format file, a header line starting with chrom is skipped, or binary columnar
+                   profile (e.g. signature matrix) whose first three columns are chromosome, start and end
+    :return: regions [pd.DataFrame]
+    
+    '''
+    if is_binary_profile(bedfil):
+        regions = read_profile(bedfil, 'ATAC-Seq').iloc[:, 0 : 3].reset_index(drop=True)
+        regions.columns  = ['chrom', 'start', 'end']
+        regions['chrom'] = regions['chrom'].astype(str)
+    else:
+        regions = pd.read_csv(bedfil, sep='\t', header=None, usecols=[0, 1, 2], names=['chrom', 'start', 'end'], dtype=str)
+        regions = regions[regions['chrom'] != 'chrom'].reset_index(drop=True)
+    regions[['start', 'end']] = regions[['start', 'end']].astype(np.int64)
+    return regions
+
+def fetch_reads(bam, chrom, mapq):
+    '''
+    fetch sorted start and end positions of the reads on one chromosome. As featureCounts without -M and -p,
+    unmapped, secondary, supplementary, multi-mapping (NH > 1) and low MAPQ reads are skipped, and each mate
+    of a pair is counted as a read
+    :param bam: [str/file] indexed bam file
+    :param chrom: [str] chromosome name
+    :param mapq: [int] minimum mapping quality
+    :return: starts, ends [np.array] sorted 0-based starts and ends of the aligned spans
+    
+    '''
+    starts, ends = [], []
+    with pysam.AlignmentFile(bam, 'rb') as fp:
+        if chrom not in fp.references: return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+        for read in fp.fetch(chrom):
+            if read.flag & 0x904 or read.mapping_quality < mapq: continue
+            if read.has_tag('NH') and read.get_tag('NH') > 1: continue
+            starts.append(read.reference_start); ends.append(read.reference_end)
+    return np.sort(np.array(starts, dtype=np.int64)), np.sort(np.array(ends, dtype=np.int64))
+
+def overlap_counts(read_starts, read_ends, starts, ends):
+    '''
+    count reads overlapping each half-open region [start, end) by at least one base
+    :param read_starts: [np.array] sorted read starts
+    :param read_ends: [np.array] sorted read ends
+    :param starts: [np.array] region starts (0-based)
+    :param ends: [np.array] region ends
+    :return: counts [np.array] int32
+    
+    '''
+    counts = np.searchsorted(read_starts, ends, side='left') - np.searchsorted(read_ends, starts, side='right')
+    return counts.astype(np.int32)
+
+def single_count_reads(tasks, regions, mapq, bg=True, upstream=500000, downstream=500000):
+    '''
+    single-process counts foreground (and background) reads of peaks for (sample, bam, chromosome) shards
+    :param tasks: [list] (sample index, bam file, chromosome) of each shard
+    :param regions: [pd.DataFrame] chromosome, start and end of peaks
+    :param mapq: [int] minimum mapping quality
+    :param bg: [bool] count background reads or not, default: True
+    :param upstream: [int] upstream of the peaks, default: 500000
+    :param downstream: [int] downstream of the peaks, default: 500000
+    :return: [list] (sample index, peak index, foreground counts, background counts)
+    
+    '''
+    results, chroms = [], regions['chrom'].values
+    for idx, bam, chrom in tasks:
+        index = np.where(chroms == chrom)[0]
+        starts, ends = regions['start'].values[index], regions['end'].values[index]
+        read_starts, read_ends = fetch_reads(bam, chrom, mapq)
+        
+        fg_counts = overlap_counts(read_starts, read_ends, starts - 1, ends) # SAF coordinates are 1-based
+        if bg:
+            bg_starts = np.where(starts - upstream < 0, 1, starts - upstream)
+            bg_counts = overlap_counts(read_starts, read_ends, bg_starts - 1, ends + downstream)
         else:
-            for idx, line in enumerate(fps[0]):
-                line_infos = line.decode().strip().split('\t')
-                tmp_infos = line_infos[1 : 4] + line_infos[6 : ]
-                fp_w.write('\t'.join(tmp_infos) + '\n')
-    return 0
+            bg_counts = None
+        results.append((idx, index, fg_counts, bg_counts))
+    return results
+
+def native_get_reads(bamfils, regions, kargs, bg=True):
+    '''
+    count reads of peaks by pysam, the work is sharded by sample and chromosome across processes
+    :param bamfils: [list] bam files
+    :param regions: [pd.DataFrame] chromosome, start and end of peaks
+    :param kargs: [dict] input parameters by users, including mapq and thread
+    :param bg: [bool] extract background read counts or not, default: True
+    :return: fg_counts, bg_counts [np.array] int32 peaks x samples, bg_counts is None if bg=False
+    
+    '''
+    index_bamfile(bamfils)
+    tasks = [ (idx, bam, chrom) for idx, bam in enumerate(bamfils) for chrom in regions['chrom'].unique() ]
+    fg_counts = np.zeros((regions.shape[0], len(bamfils)), dtype=np.int32)
+    bg_counts = np.zeros((regions.shape[0], len(bamfils)), dtype=np.int32) if bg else None
+    
+    shards = multi_process(
+            tasks                         ,
+            single_count_reads            ,
+            min(kargs.thread, len(tasks)) ,
+            regions = regions             ,
+            mapq = kargs.mapq             ,
+            bg = bg
+        )
+    for idx, index, fg_cnts, bg_cnts in shards:
+        fg_counts[index, idx] = fg_cnts
+        if bg: bg_counts[index, idx] = bg_cnts
+    return fg_counts, bg_counts
+
+def write_counts_matrix(regions, fg_counts, bg_counts, cells, outfile, bak_offset=500000, fmt='TABLE'):
+    '''
+    write read counts matrix of peaks, the background-normalized ratio is written if bg_counts is given
+    :param regions: [pd.DataFrame] chromosome, start and end of peaks
+    :param fg_counts: [np.array] foreground read counts, peaks x samples
+    :param bg_counts: [np.array] background read counts, peaks x samples, or None
+    :param cells: [list] cell or mixed sample names
+    :param outfile: [str/file path] output file
+    :param bak_offset: [int] offset distance around summit to compute background read counts, default: 500000
+    :param fmt: [str] output format, TABLE or BINARY, default: TABLE
+    :return: path of the written profile
+    
+    '''
+    if bg_counts is None:
+        values = fg_counts
+    else:
+        values = np.around(fg_counts / bg_counts.astype(float) * bak_offset * 2 / 500.0, 3)
+    profile = pd.DataFrame(values, columns=cells)
+    profile = pd.concat([regions[['chrom', 'start', 'end']].reset_index(drop=True), profile], axis=1)
+    return write_profile(profile, outfile, fmt=fmt)
 
 def index_bamfile(bamfiles):
     '''
@@ -133,7 +308,7 @@ def index_bamfile(bamfiles):
     for bam in bamfiles:
         bam_index = bam + '.bai'
         if os.path.exists(bam_index): continue
-        LOGS.warn('{} index cannot be detected, create index...'.format(bamfile))
+        LOGS.warn('{} index cannot be detected, create index...'.format(bam))
         pysam.index(bam, bam_index) # create bam index
     return 0
 
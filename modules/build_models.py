@@ -6,11 +6,6 @@
 #type        : module
 #version     : 3.8
 
-#-----------------------------------------------------
-# load python modules
-
-from rpy2.robjects   import r, pandas2ri
-
 #-----------------------------------------------------
 # load own modules
 
@@ -19,30 +14,306 @@ from modules.find_markers import *
 #-----------------------------------------------------
 # global setting
 
-pandas2ri.activate()
 LOGS = log_infos() # logging informative
 
+BOXCOX_LAMBDAS    = np.arange(11) * 0.1 # Box-Cox powers to profile, as seq(0, 1, 0.1) of R
+BOXCOX_EPS        = 1 / 50.             # powers closer to 0 use the series expansion of the log transform
+BOXCOX_TRANSFORMS = {0 : ('Log', np.log), 0.5 : ('Sqrt', np.sqrt)} # transfers of the selected powers, other powers keep the profiles
+CV_SEGMENTS       = 10                  # number of random cross-validation segments
+CV_SEED           = 0                   # seed for splitting the cross-validation segments
+NULL_ITERS        = 1000                # random responses forming the null distribution of p-value
+NULL_SEED         = 0                   # seed of the random responses
+NULL_BLOCK        = 100                 # random responses fitted together
+NULL_ALPHA        = 0.05                # significance level that early stopping resolves p-values against
+NULL_ZSCORE       = 3.                  # binomial standard errors a p-value must be away from NULL_ALPHA to stop early
+NULL_CACHE        = {}                  # null distances drawn in this process for each standardized pure cells profile
+DECONV_BLOCK      = 100                 # most mixed samples deconvolved together, batch width changes rounding in the last bits
+NO_PVALUE         = 9999                # p-value reported when it is not estimated
+
+#--------------------------------------------------------------------------
+# Box-Cox transformation
+
+def column_basis(design):
+    '''
+    orthonormal basis of the column space of a design matrix, rank is decided as lstsq of numpy
+    :param design: [np.array] design matrix
+    :return: basis [np.array]
+    
+    '''
+    u, s, _ = np.linalg.svd(design, full_matrices=False)
+    return u[:, s > s[0] * max(design.shape) * np.finfo(float).eps]
+
+def boxcox_lambdas(Y, X, lambdas=BOXCOX_LAMBDAS):
+    '''
+    choose the Box-Cox power of Y ~ X by the profile log-likelihood for each mixed sample, as boxcox of MASS
+    :param Y: [np.array] positive mixed samples signal, one column per sample
+    :param X: [np.array] positive pure cells signal
+    :param lambdas: [np.array] candidate powers, default: BOXCOX_LAMBDAS
+    :return: lambdas [np.array] power with the maximal log-likelihood of each sample
+    
+    '''
+    Y = Y / np.exp(np.mean(np.log(Y), axis=0))
+    logy, basis = np.log(Y), column_basis(np.column_stack([np.ones(len(Y)), X]))
+    loglik = np.empty((len(lambdas), Y.shape[1]))
+    for i, la in enumerate(lambdas):
+        if abs(la) > BOXCOX_EPS:
+            yt = (Y ** la - 1) / la
+        else:
+            yt = logy * (1 + la * logy / 2 * (1 + la * logy / 3 * (1 + la * logy / 4)))
+        resids = yt - basis.dot(basis.T.dot(yt))
+        loglik[i] = -len(Y) / 2. * np.log(np.sum(resids ** 2, axis=0))
+    return lambdas[np.argmax(loglik, axis=0)]
+
+#--------------------------------------------------------------------------
+# SIMPLS fitting and cross-validation, as the pls package
+
+def simpls_fit(G, XY, ncomp):
+    '''
+    fit uncentered single response SIMPLS models (de Jong, 1993) of many responses at once, as simpls.fit of pls with 
+    center = FALSE, the kernel form only needs the cross products of the predictors and the responses
+    :param G: [np.array] X'X, cross product of the predictors
+    :param XY: [np.array] X'Y, cross product of the predictors and the responses, one column per response
+    :param ncomp: [int] number of components
+    :return: coeffs [np.array] components x predictors x responses, coeffs[a] uses the first a+1 components
+    
+    '''
+    R, V, Q = np.zeros((ncomp, ) + XY.shape), np.zeros((ncomp, ) + XY.shape), np.zeros((ncomp, XY.shape[1]))
+    S = XY.copy()
+    for a in range(ncomp):
+        GS = G.dot(S)
+        tnorm = np.sqrt(np.sum(S * GS, axis=0))
+        r, p = S / tnorm, GS / tnorm
+        v = p - np.einsum('apm,am->pm', V[ : a], np.einsum('apm,pm->am', V[ : a], p))
+        v = v / np.sqrt(np.sum(v * v, axis=0))
+        S = S - v * np.sum(v * S, axis=0)
+        R[a], V[a], Q[a] = r, v, np.sum(XY * r, axis=0)
+    return np.cumsum(R * Q[:, None, :], axis=0)
+
+def sum_squares(coeffs, G, XY, YY):
+    '''
+    residual sum of squares of Y ~ X for each set of coefficients, taken from the cross products only
+    :param coeffs: [np.array] components x predictors x responses, as returned by simpls_fit
+    :param G: [np.array] X'X
+    :param XY: [np.array] X'Y
+    :param YY: [np.array] sum of squares of each response
+    :return: sse [np.array] components x responses
+    
+    '''
+    return np.sum(coeffs * (np.einsum('pq,aqm->apm', G, coeffs) - 2 * XY), axis=1) + YY
+
+def simpls_cv(X, Y, ncomp, segments=CV_SEGMENTS, seed=CV_SEED):
+    '''
+    cross-validate SIMPLS over random segments, as mvrCv of pls, all responses share the segments
+    :param X: [np.array] predictors, objects in rows
+    :param Y: [np.array] responses, one column per response
+    :param ncomp: [int] number of components
+    :param segments: [int] number of segments, default: CV_SEGMENTS
+    :param seed: [int] seed of the segments, default: CV_SEED
+    :return: press [np.array] prediction error sum of squares, adj [np.array] bias correction of adjCV
+    
+    '''
+    nobj = len(Y)
+    perm = np.random.RandomState(seed).permutation(nobj)
+    G, XY, YY = X.T.dot(X), X.T.dot(Y), np.sum(Y ** 2, axis=0)
+    press, adj = np.zeros((ncomp, Y.shape[1])), np.zeros((ncomp, Y.shape[1]))
+    for seg in np.array_split(perm, segments): # segments of near-equal size, as cvsegments of pls
+        Gs, XYs, YYs = X[seg].T.dot(X[seg]), X[seg].T.dot(Y[seg]), np.sum(Y[seg] ** 2, axis=0)
+        coeffs = simpls_fit(G - Gs, XY - XYs, ncomp)
+        press += sum_squares(coeffs, Gs, XYs, YYs)
+        adj += len(seg) * sum_squares(coeffs, G, XY, YY)
+    return press, adj / nobj ** 2
+
+#--------------------------------------------------------------------------
+# Select model for deconvolution
+
+def select_models(X_norm, Y, method='SIMPLS'):
+    '''
+    fit the standardized mixed samples on the standardized pure cells profile
+    :param X_norm: [np.array] standardized pure cells profile
+    :param Y: [np.array] mixed samples signal, one column per sample
+    :param method: [str] deconvolution method, SIMPLS or LR, default: SIMPLS
+    :return: Y_norm [np.array], Y_predict [np.array], coeffs [np.array], rsquared [np.array], rmsep [np.array]
+    
+    '''
+    nobj, ncols = X_norm.shape
+    Y_norm = (Y - Y.mean(axis=0)) / Y.std(axis=0, ddof=1)
+    sst = np.sum((Y_norm - Y_norm.mean(axis=0)) ** 2, axis=0)
+    if method == 'SIMPLS':
+        G, XY = X_norm.T.dot(X_norm), X_norm.T.dot(Y_norm)
+        coeffs = simpls_fit(G, XY, ncols)
+        press, adj = simpls_cv(X_norm, Y_norm, ncols)
+        # statistics are taken at model ncols of pls, whose first model is the intercept only one
+        cv = np.vstack([sst * nobj ** 2 / (nobj - 1) ** 2, press]) / nobj
+        train = np.vstack([sst, sum_squares(coeffs, G, XY, np.sum(Y_norm ** 2, axis=0))]) / nobj
+        adjcv = cv + train - np.vstack([train[0], adj])
+        coeffs = coeffs[-1]
+        Y_predict = X_norm.dot(coeffs)
+        rsquared, rmsep = 1 - cv[ncols - 1] * nobj / sst, np.sqrt(adjcv[ncols - 1])
+    else:
+        design = np.column_stack([np.ones(nobj), X_norm])
+        coeffs = np.linalg.lstsq(design, Y_norm, rcond=None)[0]
+        Y_predict = design.dot(coeffs)
+        resids = Y_norm - Y_predict
+        coeffs, rsquared, rmsep = coeffs[1 : ], 1 - np.sum(resids ** 2, axis=0) / sst, np.sqrt(np.mean(resids ** 2, axis=0))
+    return Y_norm, Y_predict, coeffs, rsquared, rmsep
+
+def getfrac(coeffs):
+    '''
+    get relative fraction of each cell type from the regression coefficients
+    :param coeffs: [np.array] regression coefficients of pure cells, one column per sample
+    :return: fracs [np.array]
+    
+    '''
+    coeffs = np.clip(coeffs, 0, None)
+    return coeffs / coeffs.sum(axis=0)
+
+def wasserstein1d(a, b):
+    '''
+    1-Wasserstein distance between the empirical distributions of two samples of the same size, column by column
+    :param a: [np.array] first samples
+    :param b: [np.array] second samples
+    :return: dist [np.array]
+    
+    '''
+    return np.mean(np.abs(np.sort(a, axis=0) - np.sort(b, axis=0)), axis=0)
+
+#--------------------------------------------------------------------------
+# Calculate P-value of estimate results
+
+def null_distances(basis, nobj, size, rng):
+    '''
+    distances between uniformly random responses and their SIMPLS predictions with all components, which are the 
+    projections onto the pure cells profile. Standardization removes the range of the uniform draws, so the null 
+    distribution only depends on the pure cells profile and is shared by all mixed samples
+    :param basis: [np.array] orthonormal basis of the standardized pure cells profile
+    :param nobj: [int] number of peaks/genes
+    :param size: [int] number of random responses
+    :param rng: [np.random.RandomState] random number generator
+    :return: null_dists [np.array]
+    
+    '''
+    random_Y = rng.uniform(size=(nobj, size))
+    random_Y = (random_Y - random_Y.mean(axis=0)) / random_Y.std(axis=0, ddof=1)
+    return wasserstein1d(basis.dot(basis.T.dot(random_Y)), random_Y)
+
+def null_pvalues(dists, null_dists):
+    '''
+    1 - rank / N of the null distance closest to each observed distance, ranks counted in decreasing order
+    :param dists: [np.array] observed distances
+    :param null_dists: [np.array] null distances in increasing order
+    :return: pvals [np.array]
+    
+    '''
+    upper = np.searchsorted(null_dists, dists)
+    lower = np.clip(upper - 1, 0, None)
+    upper = np.clip(upper, None, len(null_dists) - 1)
+    closest = np.where(
+            np.abs(null_dists[upper] - dists) <= np.abs(null_dists[lower] - dists),
+            null_dists[upper],
+            null_dists[lower]
+        )
+    ranks = len(null_dists) - np.searchsorted(null_dists, closest, side='right') + 1.
+    return 1 - ranks / len(null_dists)
+
+def resolved(dists, null_dists, alpha=NULL_ALPHA, zscore=NULL_ZSCORE):
+    '''
+    whether each p-value is far enough from the significance level for the null distances drawn so far
+    :param dists: [np.array] observed distances
+    :param null_dists: [np.array] null distances
+    :param alpha: [float] significance level, default: NULL_ALPHA
+    :param zscore: [float] number of binomial standard errors, default: NULL_ZSCORE
+    :return: [np.array] bool of each observed distance
+    
+    '''
+    ntotal = len(null_dists)
+    nbelow = np.sum(null_dists[:, None] < dists, axis=0)
+    prior = (nbelow + 1.) / (ntotal + 2)
+    return np.abs(nbelow / float(ntotal) - alpha) > zscore * np.sqrt(prior * (1 - prior) / ntotal)
+
+def cached_null(X_norm, iter_num, seed):
+    '''
+    random number generator and null distances drawn so far for a standardized pure cells profile, so the calls of 
+    one process (e.g. the tasks of a worker) draw the null distribution only once
+    :param X_norm: [np.array] standardized pure cells profile
+    :param iter_num: [int] number of random responses
+    :param seed: [int] seed of the random responses
+    :return: entry [list] [random number generator, null distances]
+    
+    '''
+    key = (__import__('hashlib').sha1(np.ascontiguousarray(X_norm)).hexdigest(), X_norm.shape, iter_num, seed)
+    if key not in NULL_CACHE:
+        if len(NULL_CACHE) >= len(BOXCOX_TRANSFORMS) + 1: NULL_CACHE.clear()
+        NULL_CACHE[key] = [np.random.RandomState(seed), np.array([])]
+    return NULL_CACHE[key]
+
+def calc_pvals(X_norm, dists, iter_num=NULL_ITERS, seed=NULL_SEED, early_stop=False):
+    '''
+    p-values of the observed distances of mixed samples, random responses are fitted in blocks against one factorized 
+    pure cells profile
+    :param X_norm: [np.array] standardized pure cells profile
+    :param dists: [np.array] distances between the observed and the predicted signal of mixed samples
+    :param iter_num: [int] number of random responses, default: NULL_ITERS
+    :param seed: [int] seed of the random responses, default: NULL_SEED
+    :param early_stop: [bool] take the p-value of a sample once it is resolved against NULL_ALPHA, default: False
+    :return: pvals [np.array]
+    
+    '''
+    entry, basis, ntotal = cached_null(X_norm, iter_num, seed), None, 0
+    pvals, pending = np.empty(len(dists)), np.ones(len(dists), dtype=bool)
+    while pending.any() and ntotal < iter_num:
+        ntotal = min(ntotal + NULL_BLOCK, iter_num)
+        if len(entry[1]) < ntotal:
+            basis = column_basis(X_norm) if basis is None else basis
+            entry[1] = np.append(entry[1], null_distances(basis, len(X_norm), ntotal - len(entry[1]), entry[0]))
+        if early_stop:
+            done = pending & resolved(dists, entry[1][ : ntotal])
+            pvals[done], pending = null_pvalues(dists[done], np.sort(entry[1][ : ntotal])), pending & ~done
+    pvals[pending] = null_pvalues(dists[pending], np.sort(entry[1][ : ntotal]))
+    return pvals
+
 #--------------------------------------------------------------------------
 # SIMPLS deconvolution method
 
-def SIMPLS(Y, X, method, pvalue=False):
+def SIMPLS(Y, X, method, pvalue=False, iter_num=NULL_ITERS, seed=NULL_SEED, early_stop=False):
     '''
-    :param Y: [pd.DataFrame] mixed sample profile
+    deconvolve all mixed samples at once, samples sharing the Box-Cox transfer are solved together against one 
+    standardized and factorized pure cells profile
+    :param Y: [pd.DataFrame] mixed samples profile
     :param X: [pd.DataFrame] pure cells profile
-    :param method: [str] deconvolution method, include PCR and SIMPLS
-    :return: deconvolution results
+    :param method: [str] deconvolution method, include LR and SIMPLS
+    :param pvalue: [bool] estimate P-value or not, default: False
+    :param iter_num: [int] number of random responses of the null distribution, default: NULL_ITERS
+    :param seed: [int] seed of the random responses, default: NULL_SEED
+    :param early_stop: [bool] take the p-value of a sample once it is resolved, default: False
+    :return: deconvolution results [np.array], one row per sample
+    
+    '''
+    X, Y = np.asfortranarray(X, dtype=float) + 1, np.asfortranarray(Y, dtype=float) + 1
+    lambdas, results = boxcox_lambdas(Y, X), np.empty((Y.shape[1], X.shape[1] + 3))
+    for lam in np.unique(lambdas):
+        cols, Xt = np.where(lambdas == lam)[0], X
+        Yt = Y[:, cols]
+        if lam in BOXCOX_TRANSFORMS:
+            name, transfer = BOXCOX_TRANSFORMS[lam]
+            Xt, Yt = transfer(X), transfer(Yt)
+            LOGS.warn('Lambda = {}, {} transfer for {} of {} samples'.format(lam, name, method, len(cols)))
+        
+        X_norm = (Xt - Xt.mean()) / Xt.std(ddof=1)
+        Y_norm, Y_predict, coeffs, r2, rmse = select_models(X_norm, Yt, method)
+        pvals = calc_pvals(X_norm, wasserstein1d(Y_predict, Y_norm), iter_num, seed, early_stop) \
+                if pvalue else np.full(len(cols), NO_PVALUE)
+        results[cols] = np.column_stack([getfrac(coeffs).T, r2, rmse, pvals])
+    return results
+
+def deconv_rows(blocks, X=None, method='SIMPLS', pvalue=False, iter_num=NULL_ITERS, seed=NULL_SEED, early_stop=False):
+    '''
+    deconvolve blocks of mixed samples stored in rows, worker function of the parallel deconvolution
+    :param blocks: [list] blocks of mixed samples, one row per sample
+    :param X: [np.array] pure cells profile
+    :return: [list] deconvolution results of each block
     
     '''
-    import pkg_resources
-    r.assign('Y', Y); r.assign('X', X); r.assign('method', method); r.assign('pvalue', pvalue)
-    r_file = pkg_resources.resource_filename('DeconPeaker', 'modules/simpls_deconv.r')
-    r('''
-        source('{}')
-        results <- simpls_deconv(Y, X, method, pvalue)
-    '''.format(r_file))
-    rmse, coeff, r2, pvalue = r('results$rmse')[0], r('results$coeffs'), r('results$R2')[0], r('results$pval')[0]
-    infos  = [r2, rmse, pvalue]
-    return np.append(coeff, infos)
+    return [ SIMPLS(block.T, X, method, pvalue, iter_num, seed, early_stop) for block in blocks ]
 
 #--------------------------------------------------------------------------
 # RSIMPLS deconvolution method
@@ -70,23 +341,51 @@ def SIMPLS(Y, X, method, pvalue=False):
 #--------------------------------------------------------------------------
 # SIMPLS: An alternative approach to partial least squares regression
 
-def deconv(Y, X, method='SIMPLS', pvalue=False):
+def deconv_block(nsamples, threads=1):
+    '''
+    number of mixed samples of each deconvolution task, blocks are narrowed so that all processes get work
+    :param nsamples: [int] number of mixed samples
+    :param threads: [int] number of processes, default: 1
+    :return: block [int]
+    
+    '''
+    return max(1, min(DECONV_BLOCK, -(-nsamples // max(1, threads))))
+
+def deconv(Y, X, method='SIMPLS', pvalue=False, iter_num=NULL_ITERS, seed=NULL_SEED, early_stop=False, threads=1, block=None):
     '''
     deconvolution using a SIMPLS strategy
     :param Y: [pd.DataFrame] mixed sample profile
     :param X: [pd.DataFrame] pure cells profile
     :param method: [str] deconvolution method, including SIMPLS and RSIMPLS, default: SIMPLS
     :param pvalue: [bool] estimate P-value or not, default: False
+    :param iter_num: [int] number of random responses of the null distribution, default: NULL_ITERS
+    :param seed: [int] seed of the random responses, default: NULL_SEED
+    :param early_stop: [bool] take the p-value of a sample once it is resolved, default: False
+    :param threads: [int] number of processes deconvolving blocks of samples, default: 1
+    :param block: [int] number of samples of each block, default: None (deconv_block of the samples and threads)
     :return: coeffs [np.array]
     
     '''
-    mixsnames, purecells, deconv_results = Y.columns, X.columns, [] 
+    mixsnames, purecells = Y.columns, X.columns
+    block = block if block else deconv_block(len(mixsnames), threads)
     
-    #if method == 'RSIMPLS':
-    #    deconv_results = RSIMPLS(Y, X)
-    #else:
-    for sn in mixsnames: deconv_results.append(SIMPLS(Y[sn], X, method, pvalue))
-        #deconv_results = [ SIMPLS(Y[sn], X, method, pvalue) for sn in mixsnames ]
+    if threads > 1 and len(mixsnames) > block:
+        deconv_results = shared_multi_process(
+                Y.values.T            ,
+                deconv_rows           ,
+                threads               ,
+                len(purecells) + 3    ,
+                block                 ,
+                X = X.values          ,
+                method = method       ,
+                pvalue = pvalue       ,
+                iter_num = iter_num   ,
+                seed = seed           ,
+                early_stop = early_stop
+            )
+    else:
+        blocks = [ Y.values.T[start : start + block] for start in range(0, len(mixsnames), block) ]
+        deconv_results = np.concatenate(deconv_rows(blocks, X.values, method, pvalue, iter_num, seed, early_stop))
     deconv_results = pd.DataFrame(
             deconv_results,
             columns = np.append(purecells, ['Rsquared', 'RMSEP', 'P.value']),
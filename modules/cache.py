@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+#title      : cache.py
+#decription : Persistent content-addressed cache of intermediate results
+#author     : Huamei Li
+#date       : 18/10/2026
+#type       : module
+#version    : 3.8
+
+#-----------------------------------------------------
+# load python modules
+
+import pickle
+import hashlib
+
+#-----------------------------------------------------
+# load own modules
+
+from modules.utils import *
+
+#-----------------------------------------------------
+# global setting
+
+LOGS = log_infos() # logging informative
+
+#-----------------------------------------------------
+
+def file_signature(path):
+    '''
+    signature of an input file, changes whenever the file is replaced or modified
+    :param path: [str/file] file path
+    :return: [tuple] absolute path, size and modification time (ns)
+    
+    '''
+    stat = os.stat(path)
+    return (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+def file_checksum(path, block_size=1 << 20):
+    '''
+    content hash of an input file, binary profile directories are hashed file by file in name order. Unlike
+    file_signature it does not change when the same content is copied or touched
+    :param path: [str/file/dir] file or directory path
+    :param block_size: [int] bytes read at once, default: 1 MB
+    :return: [str] sha1 hex digest
+    
+    '''
+    paths = [ os.path.join(path, name) for name in sorted(os.listdir(path)) ] if os.path.isdir(path) else [path]
+    sha1  = hashlib.sha1()
+    for fil in paths:
+        sha1.update(os.path.basename(fil).encode())
+        with open(fil, 'rb') as fp:
+            for block in iter(lambda : fp.read(block_size), b''):
+                sha1.update(block)
+    return sha1.hexdigest()
+
+def frame_checksum(df):
+    '''
+    content hash of a dataframe, e.g. the peak set which reads are counted on
+    :param df: [pd.DataFrame] data frame
+    :return: [str] sha1 hex digest
+    
+    '''
+    return hashlib.sha1(pd.util.hash_pandas_object(df, index=False).values.tobytes()).hexdigest()
+
+def cache_key(*kargs):
+    '''
+    build the cache key from an artifact label, input file signatures and the parameters it depends on
+    :param kargs: [object] variable parameters, must have a stable repr
+    :return: [str] sha1 hex digest
+    
+    '''
+    return hashlib.sha1(repr(kargs).encode()).hexdigest()
+
+def cache_load(cachedir, key):
+    '''
+    load a cached artifact and mark it as recently used
+    :param cachedir: [str/dir] cache directory, None means caching is disabled
+    :param key: [str] cache key
+    :return: cached object, None if it does not exist
+    
+    '''
+    if not cachedir: return None
+    path = os.path.join(cachedir, key + '.pkl')
+    try:
+        with open(path, 'rb') as fp:
+            obj = pickle.load(fp)
+        os.utime(path, None) # modification time keeps the LRU order
+    except (IOError, OSError, EOFError, pickle.UnpicklingError):
+        return None
+    return obj
+
+def cache_save(cachedir, key, obj):
+    '''
+    save an artifact into the cache, written to a temporary file first so concurrent processes never read partial files
+    :param cachedir: [str/dir] cache directory, None means caching is disabled
+    :param key: [str] cache key
+    :param obj: [object] picklable artifact
+    :return: 0
+    
+    '''
+    if not cachedir: return 0
+    mk_dir(cachedir)
+    path = os.path.join(cachedir, key + '.pkl')
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as fp:
+        pickle.dump(obj, fp, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+    return 0
+
+def evict_cache(cachedir, max_size):
+    '''
+    remove least recently used artifacts until the cache fits into the size limit
+    :param cachedir: [str/dir] cache directory, None means caching is disabled
+    :param max_size: [float] size limit in GB
+    :return: 0
+    
+    '''
+    if not (cachedir and os.path.exists(cachedir)): return 0
+    entries = []
+    for name in os.listdir(cachedir):
+        if not name.endswith('.pkl'): continue
+        try:
+            stat = os.stat(os.path.join(cachedir, name))
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, name))
+    
+    total, limit = sum(entry[1] for entry in entries), max_size * 1024 ** 3
+    for mtime, size, name in sorted(entries):
+        if total <= limit: break
+        try:
+            os.remove(os.path.join(cachedir, name))
+        except OSError:
+            pass
+        total -= size
+    return 0
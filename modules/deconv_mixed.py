@@ -6,6 +6,11 @@
 #type        : module
 #version     : 3.8
 
+#-----------------------------------------------------
+# load python modules
+
+from functools import partial
+
 #-----------------------------------------------------
 # load own modules
 
@@ -19,7 +24,7 @@ LOGS = log_infos() # logging informative
 
 #-----------------------------------------------------
 
-def normalize_profile(profile, method, fields, log=True, outfile=None):
+def normalize_profile(profile, method, fields, log=True, outfile=None, threads=1, dtype=None):
     '''
     normalize pure profile to remove batch bias
     :param profile: [pd.DataFrame] profile matrix of peaks for all samples
@@ -27,11 +32,13 @@ def normalize_profile(profile, method, fields, log=True, outfile=None):
     :param fields: [list] data fields which need to be normalized
     :param log: [bool] log-transfer data or not, default: True
     :param outfile: [str] prefix name of output file, default: None
+    :param threads: [int] threads of quantile normalization, default: 1
+    :param dtype: [str/np.dtype] float type kept for the normalized values, default: None (as returned by the method)
     :return: normalize profile [pd.DataFrame]
     
     '''
     norm_funcs = {
-            'QN'   : quantile_norm      ,
+            'QN'   : partial(quantile_norm, threads=threads),
             'DESeq': deseq_norm         ,
             'UQN'  : upper_quantile_norm,
             'PPM'  : ppm_norm           ,
@@ -39,6 +46,8 @@ def normalize_profile(profile, method, fields, log=True, outfile=None):
         }
     
     profile = norm_funcs[method](profile, fields)
+    if dtype and (profile.dtypes[fields] != dtype).any():
+        profile[fields] = profile[fields].astype(dtype)
     if log:
         profile[fields] = np.log2(1 + profile[fields])
     if outfile:
@@ -58,27 +67,16 @@ def filter_weakpeaks(profile):
 
     return profile
 
-def cellspecificpeaks(profile, phenotype, kargs=None):
+def write_signature(sigmatrix, ctsp_peaks, phenotype, kargs):
     '''
-    obtained cell specific peaks of pure cells
-    :param profile: [pd.DataFrame] pre-processed read counts
+    write signature matrix, bars of cell specific peak counts and the signature heatmap
+    :param sigmatrix: [pd.DataFrame] signature matrix
+    :param ctsp_peaks: [pd.DataFrame] cell specific peaks, cell type columns are 1 for the top cell type
     :param phenotype: [pd.DataFrame] phenotype classes of all samples
-    :param method: [str] select which method to find cell specific peaks
-    :param thread: [int] thread number, default: None
     :param kargs: [int] other parameters, some of them may be used
-    :return: 0
+    :return: sigmatrix [pd.DataFrame]
     
     '''
-    sigmatrix, ctsp_peaks = find_marker_peaks(
-            profile             , 
-            phenotype           , 
-            kargs.thread        , 
-            kargs.score         , 
-            kargs.min_group_size, 
-            kargs.max_group_size,
-            kargs.ratio         ,
-            kargs.merge_replicates
-        )
     fields = sigmatrix.columns[3 : ]
     if kargs.lib_strategy in ['RNA-Seq', 'Microarray']:
         bool_v, sigmatrix = True, sigmatrix[fields]
@@ -90,13 +88,50 @@ def cellspecificpeaks(profile, phenotype, kargs=None):
         }), os.path.join(kargs.outdir, kargs.prefix + '_cstps_counts'), platform=kargs.lib_strategy)
 
     outfile = os.path.join(kargs.outdir, kargs.prefix + '_signature_matrix.xls')
-    sigmatrix.to_csv(outfile, sep='\t', header=True, index=bool_v)
+    write_profile(sigmatrix, outfile, kargs.lib_strategy, fmt=kargs.out_format, index=bool_v)
     
     outfig = os.path.join(kargs.outdir, kargs.prefix + '_signature_heatmap')
     if sigmatrix.shape[0] <= 10000: cluster_heatmap(sigmatrix[fields], outfig)
     return sigmatrix
 
-def deconvcells(mixsamples, sigprofile, lib_strategy=None, pvalue=False, method='SIMPLS', norm=None, outdir='./'):
+def cellspecificpeaks(profile, phenotype, kargs=None, qvalues=None):
+    '''
+    obtained cell specific peaks of pure cells
+    :param profile: [pd.DataFrame] pre-processed read counts, or merged replicates of marker_qvalues if qvalues is given
+    :param phenotype: [pd.DataFrame] phenotype classes of all samples
+    :param method: [str] select which method to find cell specific peaks
+    :param thread: [int] thread number, default: None
+    :param kargs: [int] other parameters, some of them may be used
+    :param qvalues: [pd.DataFrame] q-values of marker_qvalues, e.g. loaded from cache, the regression is skipped, default: None
+    :return: 0
+    
+    '''
+    selection = [
+            kargs.score         , 
+            kargs.min_group_size, 
+            kargs.max_group_size,
+            kargs.ratio         ,
+            getattr(kargs, 'dtype', None)
+        ]
+    if qvalues is None:
+        profile, qvalues = marker_qvalues(profile, phenotype, kargs.thread, kargs.merge_replicates)
+    sigmatrix, ctsp_peaks = select_marker_peaks(profile, phenotype, qvalues, *selection)
+    return write_signature(sigmatrix, ctsp_peaks, phenotype, kargs)
+
+def chunked_cellspecificpeaks(profile_file, phenotype, kargs):
+    '''
+    obtained cell specific peaks of pure cells out of core, the profile is streamed from disk in blocks of kargs.chunk_size peaks
+    :param profile_file: [str/file] tab-separated or binary columnar profile of pure cells
+    :param phenotype: [pd.DataFrame] phenotype classes of all samples
+    :param kargs: [int] other parameters, some of them may be used
+    :return: sigmatrix [pd.DataFrame]
+    
+    '''
+    sigmatrix, ctsp_peaks = chunked_find_marker_peaks(profile_file, phenotype, kargs)
+    return write_signature(sigmatrix, ctsp_peaks, phenotype, kargs)
+
+def deconvcells(mixsamples, sigprofile, lib_strategy=None, pvalue=False, method='SIMPLS', norm=None, outdir='./', \
+        iter_num=NULL_ITERS, seed=NULL_SEED, early_stop=False, threads=1):
     '''
     mixed samples will be deconvolved based on the signal of the cell-specific peaks of the pure cells
     :param mixsamples: [pd.DataFrame] multiple-mixed-samples singal matrix file
@@ -106,6 +141,10 @@ def deconvcells(mixsamples, sigprofile, lib_strategy=None, pvalue=False, method=
     :param method: [str] deconvolution method, including SIMPLS and RSIMPLS, default: SIMPLS
     :param norm: [str] normalize method, default: None
     :param outdir: [str/dir] output directory, default: ./
+    :param iter_num: [int] number of random responses of the p-value null distribution, default: NULL_ITERS
+    :param seed: [int] seed of the random responses, default: NULL_SEED
+    :param early_stop: [bool] take the p-value of a sample once it is resolved, default: False
+    :param threads: [int] number of processes deconvolving the mixed samples, default: 1
     :return: deconvoluted results file
     
     '''  
@@ -119,10 +158,101 @@ def deconvcells(mixsamples, sigprofile, lib_strategy=None, pvalue=False, method=
                 log = False       , 
                 outfile = None
             )       
-    deconv_results = deconv(mixsamples, sigprofile, method=method, pvalue=pvalue)
+    deconv_results = deconv(
+            mixsamples             , 
+            sigprofile             , 
+            method = method        , 
+            pvalue = pvalue        , 
+            iter_num = iter_num    , 
+            seed = seed            , 
+            early_stop = early_stop, 
+            threads = threads
+        )
     outfile = os.path.join(outdir, 'deconPeaker-Results.xls')
     deconv_results.to_csv(outfile, sep='\t', index=True, header=True)
     
     outfig = os.path.join(outdir, 'deconPeaker-Results')
     stack_bars(deconv_results[sigprofile.columns], outfig)
     return deconv_results
+
+def stream_mixture(mixture_file, sigprofile, lib_strategy, block_values, workdir):
+    '''
+    stream the mixed samples profile once in blocks of rows, the rows of the signature peaks/genes/probes are kept in a 
+    column-major .npy file and its log scale is checked on all values as load_profile does
+    :param mixture_file: [str/file] mixed samples profile, tab-separated or binary columnar format
+    :param sigprofile: [pd.DataFrame] pure cell profile
+    :param lib_strategy: [str] a string indicating the type of the profile measurements
+    :param block_values: [int] approximate number of values of each block of rows
+    :param workdir: [str/dir] directory of the kept rows
+    :return: sigprofile [pd.DataFrame] rows found in the mixed samples, mixture [np.memmap] kept rows x samples, 
+             rows [np.array] kept rows of sigprofile, samples [list], logc [bool]
+    
+    '''
+    samples = profile_samples(mixture_file, lib_strategy)
+    sigkeys = pd.Index(peak_keys(sigprofile) if lib_strategy == 'ATAC-Seq' else sigprofile.index)
+    mixture = np.lib.format.open_memmap(
+            os.path.join(workdir, 'mixture_signature_rows.npy'), 
+            mode = 'w+'                        , 
+            dtype = np.float64                 , 
+            shape = (len(sigkeys), len(samples)), 
+            fortran_order = True
+        )
+    found, stats = np.zeros(len(sigkeys), dtype=bool), None
+    for keys, values in profile_row_blocks(mixture_file, lib_strategy, max(1, block_values // len(samples))):
+        stats = threshold_stats(values, stats)
+        hits  = sigkeys.get_indexer(keys)
+        rows  = np.where(hits >= 0)[0]
+        rows  = rows[~found[hits[rows]]]
+        rows  = rows[np.sort(np.unique(hits[rows], return_index=True)[1])] # first occurrence of duplicated peaks
+        mixture[hits[rows]], found[hits[rows]] = values[rows], True
+    mixture.flush()
+    
+    logc = is_logscale(None, threshold_percentiles(stats))
+    return sigprofile[found], mixture, np.where(found)[0], samples, logc
+
+def streamed_deconvcells(mixture_file, sigprofile, kargs):
+    '''
+    deconvcells for mixed samples profiles too wide for memory, only the rows of the signature peaks are kept (on disk) 
+    and the mixed samples are deconvolved in chunks of kargs.chunk_size samples, the results of each chunk are appended 
+    to the output file as soon as they are done. Chunks are rounded up to whole deconv_block blocks of all samples, 
+    so that the results are the same as deconvcells, the stack bars figure is not drawn
+    :param mixture_file: [str/file] mixed samples profile, tab-separated or binary columnar format
+    :param sigprofile: [pd.DataFrame] pure cell profile
+    :param kargs: [argparse.Namespace] deconvolution parameters, including chunk_size, norm, tmpdir and outdir
+    :return: deconvoluted results [pd.DataFrame]
+    
+    '''
+    samples = profile_samples(mixture_file, kargs.lib_strategy)
+    block = deconv_block(len(samples), kargs.thread)
+    chunk = -(-kargs.chunk_size // block) * block
+    sigprofile, mixture, rows, samples, logc = stream_mixture(
+            mixture_file             , 
+            sigprofile               , 
+            kargs.lib_strategy       , 
+            chunk * len(sigprofile)  , 
+            kargs.tmpdir
+        )
+    sigprofile = sigprofile[sigprofile.columns[3 : ]]
+    outfile = os.path.join(kargs.outdir, 'deconPeaker-Results.xls')
+    
+    for start in range(0, len(samples), chunk):
+        mixsamples = pd.DataFrame(mixture[rows, start : start + chunk], index=sigprofile.index, columns=samples[start : start + chunk])
+        if logc: mixsamples = 2 ** mixsamples
+        if kargs.norm: mixsamples = normalize_profile(mixsamples, kargs.norm, mixsamples.columns, log=False, outfile=None)
+        deconv_results = deconv(
+                mixsamples                     , 
+                sigprofile                     , 
+                method = kargs.method          , 
+                pvalue = kargs.pvalue          , 
+                iter_num = kargs.iterations    , 
+                seed = kargs.seed              , 
+                early_stop = kargs.early_stop  , 
+                threads = kargs.thread         , 
+                block = block
+            )
+        deconv_results.to_csv(outfile, sep='\t', index=True, header=not start, mode='a' if start else 'w')
+        LOGS.info('Deconvolved {} of {} mixed samples'.format(min(start + chunk, len(samples)), len(samples)))
+    
+    del mixture
+    LOGS.info('Stack bars of deconPeaker results are not drawn in chunks, their memory grows with the number of mixed samples')
+    return pd.read_csv(outfile, sep='\t', header=0, index_col=0)
@@ -11,7 +11,7 @@
 
 from modules.normalize_methods       import *
 from modules.optimize_specific_peaks import *
-from modules.lm_reg import get_cell_specific_pvals
+from modules.lm_reg import get_cell_specific_pvals, cell_specific_pvals
 
 #--------------------------------------------------------
 # global setting
@@ -20,28 +20,38 @@ LOGS = log_infos() # logging informative
 
 #--------------------------------------------------------
 
-def find_marker_peaks(profile, phenotypes, *kargs):
+def marker_qvalues(profile, phenotypes, threads=1, merge_method='mean'):
     '''
-    find marker cell type specific peaks accross cells
-    :param profile: [pd.DataFrame] pure sample profile
+    regression stage of find_marker_peaks, it only depends on the normalized profile and the phenotypes
+    :param profile: [pd.DataFrame] normalized pure sample profile
     :param phenotypes: [pd.DataFrame] replicate file which contains cell positon in the dataframe
-    :return: sigmatrix [pd.DataFrame]
+    :param threads: [int] threads number, default: 1
+    :param merge_method: [str] merge method of replicates, default: mean
+    :return: profile [pd.DataFrame] merged replicates of each cell type, qvalues [pd.DataFrame]
     
     '''
-    fields  = profile.columns[3 : ]
-    threads, pi_score_cutoff, min_group_size, max_group_size, exp_ratio, merge_method = kargs
-    
     qvalues = get_cell_specific_pvals(
             profile   , 
             phenotypes, 
-            fields    , 
+            profile.columns[3 : ], 
             threads = threads
         )
     
     profile = profile[~profile.index.duplicated(keep='first')]
     qvalues = qvalues[~qvalues.index.duplicated(keep='first')]
     profile = merged_replicates(profile, phenotypes, method=merge_method).loc[qvalues.index]
+    return profile, qvalues
+
+def select_marker_peaks(profile, phenotypes, qvalues, *kargs):
+    '''
+    selection stage of find_marker_peaks, peaks are scored and the group size is optimized
+    :param profile: [pd.DataFrame] merged replicates of each cell type returned by marker_qvalues
+    :param phenotypes: [pd.DataFrame] replicate file which contains cell positon in the dataframe
+    :param qvalues: [pd.DataFrame] q-values returned by marker_qvalues
+    :return: sigmatrix [pd.DataFrame], ctsp_peaks [pd.DataFrame]
     
+    '''
+    pi_score_cutoff, min_group_size, max_group_size, exp_ratio, dtype = kargs
     LOGS.info('{} cell type specific peaks across {} cell types were identified'.format(profile.shape[0], phenotypes.shape[0]))
     
     LOGS.info('Performing optimization for cell type specific peaks')
@@ -52,8 +62,92 @@ def find_marker_peaks(profile, phenotypes, *kargs):
             min_group_size , 
             max_group_size ,
             pi_score_cutoff,
-            exp_ratio      
+            exp_ratio      ,
+            dtype = dtype or np.float64
         )
     max_vals = np.max(profile[phenotypes.index], axis=1)
     ctsp_peaks[phenotypes.index] = ctsp_peaks[phenotypes.index].ge(max_vals, axis=0).astype(int)
     return sigmatrix, ctsp_peaks
+
+def find_marker_peaks(profile, phenotypes, *kargs):
+    '''
+    find marker cell type specific peaks accross cells
+    :param profile: [pd.DataFrame] pure sample profile
+    :param phenotypes: [pd.DataFrame] replicate file which contains cell positon in the dataframe
+    :return: sigmatrix [pd.DataFrame]
+    
+    '''
+    threads, pi_score_cutoff, min_group_size, max_group_size, exp_ratio, merge_method, dtype = kargs
+    profile, qvalues = marker_qvalues(profile, phenotypes, threads, merge_method)
+    return select_marker_peaks(profile, phenotypes, qvalues, pi_score_cutoff, min_group_size, max_group_size, exp_ratio, dtype)
+
+def chunked_find_marker_peaks(profile_file, phenotypes, kargs):
+    '''
+    out-of-core find_marker_peaks, the profile is streamed from disk in blocks of kargs.chunk_size peaks, tab-separated
+    profiles are converted to binary columnar format first. The first pass sorts every column on disk, which gives the
+    log scale check, the normalization reference and the weak peak cutoff of the whole profile; the second pass
+    normalizes, filters and fits each block, spilling pvalues and merged replicates to disk; pvalues are then adjusted
+    together by p_adjust_blocks, and the last pass only keeps the scored peaks in memory for select_group_size.
+    Memory depends on the block size and one column of the profile, not on the whole profile
+    :param profile_file: [str/file] tab-separated or binary columnar pure sample profile
+    :param phenotypes: [pd.DataFrame] replicate file which contains cell positon in the dataframe
+    :param kargs: [argparse.Namespace] findctsps parameters, including chunk_size, norm and tmpdir
+    :return: sigmatrix [pd.DataFrame], ctsp_peaks [pd.DataFrame]
+    
+    '''
+    chunk, workdir, cells = kargs.chunk_size, kargs.tmpdir, phenotypes.index
+    dtype   = getattr(kargs, 'dtype', None) or np.float64
+    new_npy = lambda name, dtype, shape : np.lib.format.open_memmap(os.path.join(workdir, name), mode='w+', dtype=dtype, shape=shape)
+    if not is_binary_profile(profile_file):
+        profile_file = table_to_binary_profile(profile_file, os.path.join(workdir, 'profile' + BINARY_SUFFIX), kargs.lib_strategy, chunk)
+    meta, values = open_binary_profile(profile_file)
+    valid = ~pd.Index(meta['index']).duplicated(keep='first') if meta['layout'] == 'genes' else None
+    
+    sorted_cols = sort_columns(values, os.path.join(workdir, 'sorted_columns.npy'), chunk, valid)
+    LOGS.info('Loaded {} peaks and {} samples'.format(sorted_cols.shape[1], sorted_cols.shape[0]))
+    logc = is_logscale(None, sorted_percentile(sorted_cols, LOGSCALE_PERCENTILES))
+    if logc: [ np.power(2, col, out=col) for col in sorted_cols ]
+    
+    LOGS.info('Normalizing pure profile by {} method to remove batch effects'.format(kargs.norm))
+    lib_size    = column_sums(values, os.path.join(workdir, 'columns.npy'), chunk, valid, logc) if kargs.norm == 'PPM' else None
+    normalize   = block_normalizer(sorted_cols, kargs.norm, lib_size)
+    norm_sorted = new_npy('normalized_columns.npy', dtype, sorted_cols.shape)
+    for idx, col in enumerate(sorted_cols):
+        for start in range(0, col.size, chunk):
+            norm_sorted[idx, start : start + chunk] = normalize(col[start : start + chunk, None], slice(idx, idx + 1))[:, 0]
+    lower_val = sorted_percentile(norm_sorted, 50)
+    del norm_sorted
+    
+    pvals, merged, rows, nkept = new_npy('pvalues.npy', np.float64, (sorted_cols.shape[1], len(cells))), \
+            new_npy('merged.npy', dtype, (sorted_cols.shape[1], len(cells))), new_npy('rows.npy', np.int64, (sorted_cols.shape[1], )), 0
+    for start in range(0, values.shape[0], chunk):
+        block = np.array(values[start : start + chunk], dtype=np.float64)
+        block[np.isnan(block)] = 0
+        block = normalize(2 ** block if logc else block, slice(None)).astype(dtype, copy=False)
+        keep  = ~(np.sum(block < lower_val, axis=1) == block.shape[1])
+        keep  = keep if valid is None else keep & valid[start : start + chunk]
+        
+        profile = binary_profile_frame(meta, start + np.where(keep)[0], np.asfortranarray(block[keep]), meta['columns'])
+        end = nkept + profile.shape[0]
+        pvals[nkept : end]  = cell_specific_pvals(profile[profile.columns[3 : ]].values, phenotypes, kargs.thread)
+        merged[nkept : end] = merged_replicates(profile, phenotypes, method=kargs.merge_replicates)[cells].values
+        rows[nkept : end], nkept = start + np.where(keep)[0], end
+    LOGS.info('Filtering out {} peaks and {} peaks have been remained'.format(sorted_cols.shape[1] - nkept, nkept))
+    del sorted_cols
+    
+    p_adjust_blocks(pvals[: nkept], workdir, chunk * len(cells), method='BH')
+    LOGS.info('{} cell type specific peaks across {} cell types were identified'.format(nkept, phenotypes.shape[0]))
+    
+    LOGS.info('Performing optimization for cell type specific peaks')
+    scored = []
+    for start in range(0, max(nkept, 1), chunk):
+        end = min(start + chunk, nkept)
+        profile = binary_profile_frame(meta, np.array(rows[start : end]), np.asfortranarray(merged[start : end]), cells)
+        qvalues = pd.DataFrame(np.array(pvals[start : end]), columns=cells, index=profile.index)
+        scored.append(score_peaks(profile, qvalues, cells, kargs.score, kargs.ratio, dtype))
+    profile = pd.concat(scored)
+    LOGS.info('{} cell type specific peaks across {} cell types were identified'.format(profile.shape[0], phenotypes.shape[0]))
+    
+    sigmatrix, ctsp_peaks = select_group_size(profile, phenotypes, kargs.min_group_size, kargs.max_group_size)
+    ctsp_peaks[cells] = ctsp_peaks[cells].ge(np.max(ctsp_peaks[cells], axis=1), axis=0).astype(int)
+    return sigmatrix, ctsp_peaks
@@ -15,6 +15,7 @@ from modules.utils import *
 # global setting
 
 LOGS = log_infos() # logging informative
+LM_BLOCK_SIZE = 20000 # peaks fitted together by multi_lmreg, about 100 MB of working arrays for 20 cell types
 
 #-----------------------------------------------------
 def design_bin(phenotypes):
@@ -39,80 +40,150 @@ def contranst_mat(ncells):
     X, flag, celltype = np.zeros((nrows, ncols)), 0, []
     
     for i in range(nrows):
-        X[i, int(i / (ncols - 1))] = 1
-        if flag == i / (ncols - 1): flag += 1
+        X[i, i // (ncols - 1)] = 1
+        if flag == i // (ncols - 1): flag += 1
         X[i, flag] = -1
-        if (flag + 1) / ncells:
+        if (flag + 1) // ncells:
             flag = 0
         else:
             flag += 1
-        celltype.append(i / (ncols - 1))
+        celltype.append(i // (ncols - 1))
     
     return {'mat': X, 'type': celltype }
 
-def multi_lmreg(datalst, X, XX_inv_X, XX_inv, contrasts_dict):
+def multi_lmreg(datalst, X, XX_inv_X, XX_inv, contrasts_dict, block_size=LM_BLOCK_SIZE):
     '''
-    build multiple regression and calculate pvalues
-    :param datalst: [pd.DataFrame in list] dependent variable
-    :param X: [pd.DataFrame] design matrix, indenpendent variables
-    :param XX_inv: [pd.DataFrame] XX_inv = inv((X'X))X'
+    build multiple regression and calculate pvalues, peaks are fitted together in blocks of rows by matrix operations
+    :param datalst: [np.array in list] dependent variable, peaks x samples
+    :param X: [np.array] design matrix, indenpendent variables
+    :param XX_inv_X: [np.array] XX_inv_X = inv((X'X))X'
+    :param XX_inv: [np.array] XX_inv = inv((X'X))
     :param contrasts_dict: [np.matrix] contrast dictionary, include contrast matrix, pairwise sum of sample counts
-    :return pv_infos [list in list]
+    :param block_size: [int] number of peaks fitted together, bounds the memory, default: LM_BLOCK_SIZE
+    :return pvalst [list] pvalues of each block, peaks x cell types
    
     '''
-    pvalst, (nrows, celltypecnt) = [], X.shape
-    data, cellnames, peaknames = datalst[0].values, X.columns.tolist(), datalst[0].index
+    X, celltypecnt = np.asarray(X, dtype=float), X.shape[1]
     obs_cnts = np.sum(X, axis=0)
     contrast, cell_cluster = contrasts_dict['mat'], np.array(contrasts_dict['type'])
+    se_weight = contrast.T * np.dot(XX_inv, contrast.T) # diag(C diag(v) XX_inv C') = v . se_weight
+    se_scale  = contrasts_dict['cnts'] - 2
+    dfs = np.dot(np.abs(contrast), obs_cnts) - 2
+    # t.sf decreases with t, so the max pvalue of the contrasts sharing a cell type and degrees of freedom is sf of the min t
+    contrast_groups = [ [ (df, np.where((cell_cluster == i) & (dfs == df))[0]) for df in np.unique(dfs[cell_cluster == i]) ] \
+            for i in range(celltypecnt) ]
     
-    for idx, Y in enumerate(data):
-        betas = np.dot(XX_inv_X, Y)
-        resid = Y - np.dot(X, betas)
-        sigma = np.dot(resid ** 2, X) / (obs_cnts)
+    pvalst = []
+    for data in datalst:
+        data = np.asarray(data, dtype=float)
+        for start in range(0, data.shape[0], block_size):
+            Y = data[start : start + block_size]
+            betas = np.dot(Y, XX_inv_X.T)
+            resid = Y - np.dot(betas, X.T)
+            sigma = np.dot(resid ** 2, X) / obs_cnts
 
-        beta_differ = np.dot(contrast, betas)
-        var_betahat = np.dot(np.diag(sigma * (obs_cnts - 1)), XX_inv)
-        beta_se_val = np.sqrt(np.diagonal(np.dot(np.dot(contrast, var_betahat), contrast.T)) / (contrasts_dict['cnts'] - 2))
+            beta_differ = np.dot(betas, contrast.T)
+            beta_se_val = np.sqrt(np.dot(sigma * (obs_cnts - 1), se_weight) / se_scale)
+            
+            tstats = beta_differ / beta_se_val
+            pvals  = np.column_stack([ np.max([ stats.t.sf(np.min(tstats[:, index], axis=1), df) for df, index in groups ], axis=0) \
+                    for groups in contrast_groups ])
+            pvalst.append(pvals)
+    return pvalst
+
+def onehot_design(X):
+    '''
+    check if each sample belongs to exactly one cell type
+    :param X: [pd.DataFrame] design matrix
+    :return: True/False [bool]
     
-        pvals = stats.t.sf(beta_differ / beta_se_val, np.dot(np.abs(contrast), obs_cnts) - 2)
-        pvals = [ np.max(pvals[cell_cluster == i]) for i in range(celltypecnt) ]
-        pvalst.append(pvals)
+    '''
+    X = np.asarray(X)
+    return bool(np.isin(X, [0, 1]).all() and (X.sum(axis=1) == 1).all())
+
+def marker_lmreg(datalst, X, block_size=LM_BLOCK_SIZE):
+    '''
+    pvalues of one-hot designs without the pairwise contrast matrix. The t statistic of cell type i against j is
+    (b_i - b_j) / sqrt((s_i + s_j) / (n_i + n_j - 2)) with s = sigma * (n - 1) / n, so the least-favourable competitor
+    of each cell type is kept by a running min over competitors, O(k^2) per peak as group variances differ so means
+    alone do not order them, and t.sf is only evaluated once per cell type and competitor group size. The pvalues
+    equal those of multi_lmreg
+    :param datalst: [np.array in list] dependent variable, peaks x samples
+    :param X: [np.array] one-hot design matrix, samples x cell types
+    :param block_size: [int] number of peaks fitted together, bounds the memory, default: LM_BLOCK_SIZE
+    :return pvalst [list] pvalues of each block, peaks x cell types
+    
+    '''
+    X = np.asarray(X, dtype=float)
+    obs_cnts = np.sum(X, axis=0)
+    sizes = np.unique(obs_cnts)
+    size_idx = np.searchsorted(sizes, obs_cnts)
+    
+    pvalst = []
+    for data in datalst:
+        data = np.asarray(data, dtype=float)
+        for start in range(0, data.shape[0], block_size):
+            Y = data[start : start + block_size]
+            means = np.dot(Y, X) / obs_cnts
+            resid = Y - np.dot(means, X.T)
+            svals = np.dot(resid ** 2, X) / obs_cnts * (obs_cnts - 1) / obs_cnts
+            
+            tmins = np.full((len(sizes), ) + means.shape, np.inf)
+            for j in range(len(obs_cnts)):
+                tstats = (means - means[:, j : j + 1]) / np.sqrt((svals + svals[:, j : j + 1]) / (obs_cnts + obs_cnts[j] - 2))
+                tstats[:, j] = np.inf # no contrast against itself
+                np.minimum(tmins[size_idx[j]], tstats, out=tmins[size_idx[j]])
+            pvals = np.max([ stats.t.sf(tmins[idx], obs_cnts + size - 2) for idx, size in enumerate(sizes) ], axis=0)
+            pvalst.append(pvals)
     return pvalst
 
-def get_cell_specific_pvals(profile, phenotypes, fields, threads=1):
+def cell_specific_pvals(values, phenotypes, threads=1, block_size=LM_BLOCK_SIZE):
+    '''
+    get unadjusted cell type specific peak pvalues, NaN pvalues are set to 1. With several threads the profile and
+    the pvalues are shared with the workers by shared_multi_process, so blocks are neither pickled nor sent back
+    :param values: [np.array] pure sample profile values, peaks x samples
+    :param phenotypes: [pd.DataFrame] phenotype informative
+    :param threads: [int] threads number, default: 1
+    :param block_size: [int] number of peaks fitted together in one block, default: LM_BLOCK_SIZE
+    :return: pvals [np.array] peaks x cell types
+    
+    '''
+    design_matrix = design_bin(phenotypes).T
+    if onehot_design(design_matrix):
+        func, kargs = marker_lmreg, {'X': design_matrix, 'block_size': block_size}
+    else:
+        XX_inv   = np.linalg.inv(np.dot(design_matrix.T, design_matrix))
+        XX_inv_X = np.dot(XX_inv, design_matrix.T)
+        contrasts_dict = contranst_mat(design_matrix.shape[1])
+        contrasts_dict['cnts'] = np.dot(np.abs(contrasts_dict['mat']), np.sum(design_matrix, axis=0))
+        func, kargs = multi_lmreg, {
+                'X'             : design_matrix ,
+                'XX_inv_X'      : XX_inv_X      ,
+                'XX_inv'        : XX_inv        ,
+                'contrasts_dict': contrasts_dict,
+                'block_size'    : block_size
+            }
+    
+    nblocks = -(-values.shape[0] // block_size)
+    if threads > 1 and nblocks > 1:
+        pval_infos = shared_multi_process(values, func, min(threads, nblocks), design_matrix.shape[1], block_size, **kargs)
+    else:
+        pval_infos = func([ values[start : start + block_size] for start in range(0, values.shape[0], block_size) ], **kargs)
+        pval_infos = np.concatenate(pval_infos) if pval_infos else np.zeros((0, design_matrix.shape[1]))
+    pval_infos[np.isnan(pval_infos)] = 1
+    return pval_infos
+
+def get_cell_specific_pvals(profile, phenotypes, fields, threads=1, block_size=LM_BLOCK_SIZE):
     '''
     get cell type specific peak pvalues
     :param profile: [pd.DataFrame] pure sample profile matrix
     :param phenotypes: [pd.DataFrame] phenotype informative
     :param fields: [list] profile fileds for buld regression model
     :param threads: [int] threads number, default: 1
+    :param block_size: [int] number of peaks fitted together in one block, default: LM_BLOCK_SIZE
     :return: qvalues [pd.DataFrame]
     
     '''
-    design_matrix = design_bin(phenotypes).T
-    peak_profiles = np.array_split(profile[fields], threads, axis=0)
-    XX_inv   = np.linalg.inv(np.dot(design_matrix.T, design_matrix))
-    XX_inv_X = np.dot(XX_inv, design_matrix.T)
-    contrasts_dict = contranst_mat(design_matrix.shape[1])
-    contrasts_dict['cnts'] = np.dot(np.abs(contrasts_dict['mat']), np.sum(design_matrix, axis=0))
-    
-    pval_infos = multi_process(
-            peak_profiles       , 
-            multi_lmreg         , 
-            threads             , 
-            X = design_matrix   ,
-            XX_inv_X = XX_inv_X ,
-            XX_inv = XX_inv     ,
-            contrasts_dict = contrasts_dict
-        )
-    pval_infos = pd.DataFrame(pval_infos, columns=design_matrix.columns)
-    pval_infos = pval_infos.fillna(1)
-    r.assign('pvalues', pval_infos)
-    del pval_infos
-    
-    r('''
-        pvalues = as.matrix(pvalues)
-        qvalues = matrix(p.adjust(as.vector(pvalues), method='BH'), ncol=ncol(pvalues))                    
-    ''')
-    qvalues = pd.DataFrame(r('qvalues'), columns=phenotypes.index, index=profile.index)
+    pval_infos = cell_specific_pvals(profile[fields].values, phenotypes, threads, block_size)
+    qvalues = pd.DataFrame(p_adjust(pval_infos, method='BH'), columns=phenotypes.index, index=profile.index)
     return qvalues
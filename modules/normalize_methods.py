@@ -6,6 +6,12 @@
 #type        : module script
 #version     : 3.8
 
+#-----------------------------------------------------
+# load python modules
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 #-----------------------------------------------------
 # load own python modules
 
@@ -15,24 +21,169 @@ from modules.utils  import *
 # global setting
 
 LOGS = log_infos() # logging informative
+QN_BLOCK_BYTES = 1 << 23 # float64 column block sorted by quantile normalization, 8 MB (about 5x in temporaries)
+CHUNKED_NORMS = ['QN', 'PPM'] # methods normalizing blocks of peaks against statistics of the sorted columns
+STREAMED_NORMS = ['PPM'] # methods normalizing each sample on its own, so that chunks of samples can be normalized apart
 
 #-----------------------------------------------------
 
-def quantile_norm(profile, fields):
+def quantile_blocks(values, block_bytes=QN_BLOCK_BYTES):
+    '''
+    split columns into blocks, each block of float64 columns takes about block_bytes memory
+    :param values: [np.array] matrix, row=peaks, column=cell
+    :param block_bytes: [int] memory of each block, default: QN_BLOCK_BYTES
+    :return: blocks [list] column slices
+    
+    '''
+    nrows, ncols = values.shape
+    width = max(1, min(ncols, int(block_bytes // max(nrows * 8, 1))))
+    return [ slice(start, min(start + width, ncols)) for start in range(0, ncols, width) ]
+
+def quantile_norm_array(values, out=None, threads=1, block_bytes=QN_BLOCK_BYTES, keep_order=None):
+    '''
+    quantile normalization of a matrix by blocks of columns, so only one block per thread is held in memory besides
+    the input and output, both of which may be memory-mapped arrays. Ties get the quantile of the truncated average
+    rank, as rankdata followed by an int cast did
+    :param values: [np.array/np.memmap] matrix, row=peaks, column=cell
+    :param out: [np.array/np.memmap] output matrix, default: None (a new array of the float type of values, or float64)
+    :param threads: [int] threads sorting column blocks at the same time, default: 1
+    :param block_bytes: [int] memory of each column block, default: QN_BLOCK_BYTES
+    :param keep_order: [bool] keep the int32 sort order of each column between the two passes instead of sorting
+                       again, it costs half the memory of a float64 copy of values, default: None (only for float64 values,
+                       float32 values are sorted again to keep the memory low)
+    :return: out [np.array] normalized matrix
+    
+    '''
+    nrows, ncols = values.shape
+    dtype  = values.dtype if np.issubdtype(values.dtype, np.floating) else np.float64
+    out    = np.empty((nrows, ncols), dtype=dtype) if out is None else out
+    blocks = quantile_blocks(values, block_bytes)
+    quantiles, orders, added, turn = np.zeros(nrows), {}, [0], threading.Condition()
+    keep_order = values.dtype.itemsize > 4 if keep_order is None else keep_order
+    orders_dtype = np.int32 if nrows < 2 ** 31 - 1 else np.int64
+    
+    def sort_block(cols):
+        block = np.array(values[:, cols].T, dtype=np.float64, order='C') # columns are contiguous rows of the block
+        order = orders.pop(cols.start) if cols.start in orders else np.argsort(block, axis=1)
+        return np.take_along_axis(block, order, axis=1), order
+    
+    def sum_sorted(cols):
+        block, order = sort_block(cols)
+        if keep_order: orders[cols.start] = order.astype(orders_dtype)
+        block = block.sum(axis=0)
+        with turn: # blocks are added in column order, so the sums do not depend on the thread scheduling
+            turn.wait_for(lambda : added[0] == cols.start)
+            np.add(quantiles, block, out=quantiles)
+            added[0] = cols.stop
+            turn.notify_all()
+    
+    def assign_quantiles(cols):
+        block, order = sort_block(cols)
+        rows  = np.arange(nrows, dtype=orders_dtype)
+        first = np.ones(block.shape, dtype=bool)
+        first[:, 1 : ] = block[:, 1 : ] != block[:, : -1]
+        last  = np.ones(block.shape, dtype=bool)
+        last[:, : -1]  = first[:, 1 : ]
+        first = np.maximum.accumulate(np.where(first, rows, 0), axis=1)
+        last  = np.minimum.accumulate(np.where(last, rows, nrows)[:, ::-1], axis=1)[:, ::-1]
+        
+        np.put_along_axis(block, order, quantiles[(first + last) // 2], axis=1)
+        out[:, cols] = block.T
+    
+    with ThreadPoolExecutor(max(1, threads)) as pool:
+        list(pool.map(sum_sorted, blocks))
+        quantiles /= ncols
+        list(pool.map(assign_quantiles, blocks))
+    return out
+
+def quantile_norm(profile, fields, threads=1):
     '''
     normalize profile by quantile method
     :param profile: [pd.DataFrame] pure sample profile, row=peaks, column=cell
     :param fields: [list] field names of profile which need to be normalize
+    :param threads: [int] threads sorting column blocks at the same time, default: 1
     :return: nomalized profile
     
     '''
-    X = profile[fields]
-    quantiles = np.mean(np.sort(X, axis=0), axis=1)
-    ranks = np.apply_along_axis(stats.rankdata, 0, X)
-    rank_indices = ranks.astype(int) - 1
-    profile[fields] = pd.DataFrame(quantiles[rank_indices], index=profile.index)
+    values = quantile_norm_array(profile[fields].values, threads=threads)
+    profile[fields] = pd.DataFrame(values, index=profile.index, columns=fields)
     return profile
 
+def sort_columns(values, outfile, block_size, valid=None, sort=True):
+    '''
+    sorted copy of each column of a matrix which may be larger than memory, written as the rows of a .npy file.
+    Row blocks are transposed to disk first, so each column is then read and sorted in place alone
+    :param values: [np.array/np.memmap] matrix, row=peaks, column=cell, NaN is taken as 0
+    :param outfile: [str/file] .npy file of the sorted columns
+    :param block_size: [int] number of rows read at once
+    :param valid: [np.array] boolean mask of the rows to keep, default: None (all rows)
+    :param sort: [bool] sort the columns, False only transposes them, default: True
+    :return: sorted_cols [np.memmap] cells x peaks
+    
+    '''
+    nvalid = values.shape[0] if valid is None else int(np.sum(valid))
+    sorted_cols = np.lib.format.open_memmap(outfile, mode='w+', dtype=np.float64, shape=(values.shape[1], nvalid))
+    start = 0
+    for pos in range(0, values.shape[0], block_size):
+        block = np.array(values[pos : pos + block_size], dtype=np.float64)
+        block = block if valid is None else block[valid[pos : pos + block_size]]
+        block[np.isnan(block)] = 0
+        sorted_cols[:, start : start + block.shape[0]] = block.T
+        start += block.shape[0]
+    if sort: [ col.sort() for col in sorted_cols ]
+    sorted_cols.flush()
+    return sorted_cols
+
+def column_sums(values, outfile, block_size, valid=None, logc=False):
+    '''
+    sums of the columns of a matrix which may be larger than memory, e.g. PPM library sizes. Columns are transposed
+    to disk by sort_columns and each one is summed whole in row order, as DataFrame.sum of the in-memory profile, so
+    both give the same sums to the last bit
+    :param values: [np.array/np.memmap] matrix, row=peaks, column=cell, NaN is taken as 0
+    :param outfile: [str/file] temporary .npy file of the columns, removed afterwards
+    :param block_size: [int] number of rows read at once
+    :param valid: [np.array] boolean mask of the rows to keep, default: None (all rows)
+    :param logc: [bool] values are log2 scaled and summed as 2 ** values, default: False
+    :return: sums [np.array] float64 sum of each column
+    
+    '''
+    columns = sort_columns(values, outfile, block_size, valid, sort=False)
+    sums = np.array([ np.sum(2 ** col if logc else col) for col in columns ])
+    del columns
+    os.remove(outfile)
+    return sums
+
+def block_normalizer(sorted_cols, method='QN', lib_size=None):
+    '''
+    normalization of blocks of peaks against the whole profile given by its sorted columns. QN looks values up in
+    the sorted columns, ties get the quantile of the truncated average rank as quantile_norm_array, PPM divides by the
+    column sums
+    :param sorted_cols: [np.array/np.memmap] sorted columns of the profile, cells x peaks
+    :param method: [str] one of CHUNKED_NORMS, default: QN
+    :param lib_size: [np.array] PPM column sums in row order given by column_sums, default: None (sums of the sorted
+                     columns, which may differ from those of ppm_norm in the last bits)
+    :return: normalize [function] normalize(block, cols) of a peaks x cells block of the columns cols (a slice)
+    
+    '''
+    if method == 'PPM':
+        lib_size = np.array([ np.sum(col) for col in sorted_cols ]) if lib_size is None else lib_size
+        return lambda block, cols : block / lib_size[cols] * 1e6
+    
+    quantiles = np.zeros(sorted_cols.shape[1])
+    [ np.add(quantiles, col, out=quantiles) for col in sorted_cols ]
+    quantiles /= sorted_cols.shape[0]
+    
+    def normalize(block, cols):
+        normed = np.empty(block.shape)
+        for idx, col in enumerate(range(sorted_cols.shape[0])[cols]):
+            order = np.argsort(block[:, idx], kind='stable') # sorted keys are searched much faster
+            keys  = block[order, idx]
+            first = np.searchsorted(sorted_cols[col], keys, 'left')
+            last  = np.searchsorted(sorted_cols[col], keys, 'right') - 1
+            normed[order, idx] = quantiles[(first + last) // 2]
+        return normed
+    return normalize
+
 def deseq_norm(profile, fields):
     '''
     normalize profile by deseq method
@@ -75,6 +226,75 @@ def ppm_norm(profile, fields):
     profile[fields] = profile[fields] / np.sum(profile[fields]) * 1e6
     return profile
 
+def tmm_factor(obs, ref, libsize_obs, libsize_ref, logratio_trim=0.3, sum_trim=0.05, weighting=True, a_cutoff=-1e10):
+    '''
+    TMM scaling factor of one sample against the reference sample, as .calcFactorTMM of edgeR
+    :param obs: [np.array] read counts of the sample
+    :param ref: [np.array] read counts of the reference sample
+    :param libsize_obs: [float] library size of the sample
+    :param libsize_ref: [float] library size of the reference sample
+    :param logratio_trim: [float] fraction of M values trimmed on each side, default: 0.3
+    :param sum_trim: [float] fraction of A values trimmed on each side, default: 0.05
+    :param weighting: [bool] weight M values by inverse asymptotic variances, default: True
+    :param a_cutoff: [float] cutoff on A values, default: -1e10
+    :return: factor [float]
+    
+    '''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        logR = np.log2((obs / libsize_obs) / (ref / libsize_ref))
+        absE = (np.log2(obs / libsize_obs) + np.log2(ref / libsize_ref)) / 2
+        var  = (libsize_obs - obs) / libsize_obs / obs + (libsize_ref - ref) / libsize_ref / ref
+    
+    fin = np.isfinite(logR) & np.isfinite(absE) & (absE > a_cutoff)
+    logR, absE, var = logR[fin], absE[fin], var[fin]
+    if not logR.size or np.max(np.abs(logR)) < 1e-6: return 1.0
+    
+    nums = logR.size
+    loL, loS = np.floor(nums * logratio_trim) + 1, np.floor(nums * sum_trim) + 1
+    rankR, rankE = stats.rankdata(logR), stats.rankdata(absE)
+    keep = (rankR >= loL) & (rankR <= nums + 1 - loL) & (rankE >= loS) & (rankE <= nums + 1 - loS)
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if weighting:
+            factor = np.nansum(logR[keep] / var[keep]) / np.nansum(1 / var[keep])
+        else:
+            factor = np.nanmean(logR[keep]) if keep.any() else np.nan
+    return 2 ** (0 if np.isnan(factor) else factor)
+
+def calc_tmm_factors(counts, ref_column=None, logratio_trim=0.3, sum_trim=0.05, weighting=True, a_cutoff=-1e10):
+    '''
+    TMM normalization factors of all samples, as calcNormFactors(method='TMM') of edgeR: all-zero peaks are dropped,
+    the reference is the sample whose upper quartile is closest to the mean upper quartile, and the factors are scaled
+    to a geometric mean of one
+    :param counts: [np.array] read counts, row=peaks, column=samples
+    :param ref_column: [int] index of the reference sample, default: None (chosen by upper quartiles)
+    :param logratio_trim: [float] fraction of M values trimmed on each side, default: 0.3
+    :param sum_trim: [float] fraction of A values trimmed on each side, default: 0.05
+    :param weighting: [bool] weight M values by inverse asymptotic variances, default: True
+    :param a_cutoff: [float] cutoff on A values, default: -1e10
+    :return: factors [np.array]
+    
+    '''
+    counts   = np.asarray(counts, dtype=np.float64)
+    lib_size = counts.sum(axis=0)
+    counts   = counts[(counts > 0).any(axis=1)]
+    if counts.shape[0] == 0 or counts.shape[1] == 1: return np.ones(counts.shape[1])
+    
+    if ref_column is None:
+        f75 = np.quantile(counts, 0.75, axis=0) / lib_size
+        if np.median(f75) < 1e-20:
+            ref_column = np.argmax(np.sum(np.sqrt(counts), axis=0))
+        else:
+            ref_column = np.argmin(np.abs(f75 - np.mean(f75)))
+    
+    factors = np.array([ tmm_factor(
+            counts[:, idx]           ,
+            counts[:, ref_column]    ,
+            lib_size[idx]            ,
+            lib_size[ref_column]     ,
+            logratio_trim, sum_trim, weighting, a_cutoff) for idx in range(counts.shape[1]) ])
+    return factors / np.exp(np.mean(np.log(factors)))
+
 def tmm_norm(profile, fields):
     '''
     normalize read counts by TMM method
@@ -83,12 +303,6 @@ def tmm_norm(profile, fields):
     :return: nomalized readcounts
 
     '''
-    r.assign('data', profile[fields])
-    r('''
-        library(edgeR)
-        factors <- calcNormFactors(as.matrix(data), method = 'TMM')
-    ''')
-    factors = r('factors')
+    factors = calc_tmm_factors(profile[fields].values)
     profile[fields] = profile[fields].div(factors, axis=1)
     return profile
-
@@ -67,6 +67,39 @@ def opts():
             default = 30
         )
     
+    preprocess.add_argument(
+            '--counter',
+            help = 'Engine used to count reads of peaks, featureCounts or a built-in multi-process pysam counter. \
+                    DEFAULT: featureCounts',
+            choices = ['featureCounts', 'pysam'],
+            default = 'featureCounts'
+        )
+
+    preprocess.add_argument(
+            '--out-format',
+            help = 'Format of the written read counts profile, TABLE (tab-separated) or BINARY (columnar .npy directory, \
+                    memory-mapped when loaded). DEFAULT: TABLE',
+            choices = ['TABLE', 'BINARY'],
+            default = 'TABLE'
+        )
+
+    preprocess.add_argument(
+            '--cache-dir',
+            help = 'Directory of a persistent cache of filtered peaks and read counts of each sample, so unchanged samples \
+                    are not processed again. DEFAULT: None (no cache)',
+            type = str,
+            metavar = 'CACHE-DIR',
+            default = None
+        )
+
+    preprocess.add_argument(
+            '--cache-size',
+            help = 'Size limit (GB) of the cache directory, least recently used entries are removed first. DEFAULT: 20',
+            type = float,
+            metavar = 'CACHE-SIZE',
+            default = 20
+        )
+
     preprocess.add_argument(
             '--offset',
             '-s',
@@ -170,6 +203,54 @@ def opts():
             default = 0.33
         )
 
+    findctsps.add_argument(
+            '--dtype',
+            help = 'Float type of the profile values carried through loading, normalization, replicate merging and marker \
+                    scoring. float32 roughly halves the memory; the linear models are still fitted in float64 block by block, \
+                    so q-values only differ by the rounding of the float32 inputs (relative error about 1e-6). DEFAULT: float64',
+            choices = ['float64', 'float32'],
+            default = 'float64'
+        )
+
+    findctsps.add_argument(
+            '--chunk-size',
+            help = 'Out-of-core mode for profiles larger than memory: the profile is streamed from disk in blocks of CHUNK-SIZE \
+                    peaks (tab-separated profiles are converted to binary format in the temporary directory first), global \
+                    statistics come from columns sorted on disk and only scored peaks are kept in memory. Supports QN and PPM \
+                    normalization, values are read as float64 and --dtype only applies to the normalized blocks. \
+                    DEFAULT: 0 (load the whole profile)',
+            metavar = 'CHUNK-SIZE',
+            type = int,
+            default = 0
+        )
+
+    findctsps.add_argument(
+            '--cache-dir',
+            help = 'Directory of a persistent cache of the normalized profile and q-values, keyed by the content of the profile \
+                    and phenotype files, the library strategy, normalization method and dtype. Reruns which only change --score, \
+                    --ratio, --min-group-size or --max-group-size skip normalization and regression. Not used with --chunk-size. \
+                    DEFAULT: None (no cache)',
+            type = str,
+            metavar = 'CACHE-DIR',
+            default = None
+        )
+
+    findctsps.add_argument(
+            '--cache-size',
+            help = 'Size limit (GB) of the cache directory, least recently used entries are removed first. DEFAULT: 20',
+            type = float,
+            metavar = 'CACHE-SIZE',
+            default = 20
+        )
+
+    findctsps.add_argument(
+            '--out-format',
+            help = 'Format of the written signature matrix, TABLE (tab-separated) or BINARY (columnar .npy directory, \
+                    memory-mapped when loaded). DEFAULT: TABLE',
+            choices = ['TABLE', 'BINARY'],
+            default = 'TABLE'
+        )
+
     findctsps.add_argument(
             '--thread',
             '-t',
@@ -238,6 +319,30 @@ def opts():
             default = 'FALSE'
         )
 
+    deconv.add_argument(
+            '--iterations',
+            help = 'Number of random responses forming the null distribution of P-value. DEFAULT: 1000',
+            type = int,
+            metavar = 'ITERATIONS',
+            default = 1000
+        )
+
+    deconv.add_argument(
+            '--seed',
+            help = 'Seed of the random responses of P-value, fixed for reproducible results. DEFAULT: 0',
+            type = int,
+            metavar = 'SEED',
+            default = 0
+        )
+
+    deconv.add_argument(
+            '--early-stop',
+            help = 'Take the P-value of a sample as soon as it is clearly above or below 0.05 (3 binomial standard errors \
+                    away), it then comes from fewer than --iterations responses. DEFAULT: FALSE',
+            choices = ['TRUE', 'FALSE'],
+            default = 'FALSE'
+        )
+
     deconv.add_argument(
             '--norm',
             help = 'A series method for normalizing mixture samples, including quantile, DESeq, upper quantile, PPM and TMM. \
@@ -246,10 +351,55 @@ def opts():
             default = None
         )
 
+    deconv.add_argument(
+            '--chunk-size',
+            help = 'Streaming mode for mixtures with many samples: the mixture is read once in blocks of rows and only the \
+                    signature peaks are kept (on disk, in the temporary directory), then mixed samples are deconvolved in \
+                    chunks of CHUNK-SIZE samples (rounded up to a multiple of the task size, the smaller of 100 and the \
+                    samples per --thread) and the results of each chunk are appended to deconPeaker-Results.xls (no stack \
+                    bars figure is drawn). Supports PPM normalization only. DEFAULT: 0 (load the whole mixture)',
+            metavar = 'CHUNK-SIZE',
+            type = int,
+            default = 0
+        )
+
+    deconv.add_argument(
+            '--counter',
+            help = 'Engine used to count reads of peaks in the BAM files, featureCounts or a built-in multi-process \
+                    pysam counter. DEFAULT: featureCounts',
+            choices = ['featureCounts', 'pysam'],
+            default = 'featureCounts'
+        )
+
+    deconv.add_argument(
+            '--out-format',
+            help = 'Format of the written read counts profile of mixture BAMs, TABLE (tab-separated) or BINARY (columnar .npy directory, \
+                    memory-mapped when loaded). DEFAULT: TABLE',
+            choices = ['TABLE', 'BINARY'],
+            default = 'TABLE'
+        )
+
+    deconv.add_argument(
+            '--cache-dir',
+            help = 'Directory of a persistent cache of read counts of each mixture BAM, so unchanged samples \
+                    are not processed again. DEFAULT: None (no cache)',
+            type = str,
+            metavar = 'CACHE-DIR',
+            default = None
+        )
+
+    deconv.add_argument(
+            '--cache-size',
+            help = 'Size limit (GB) of the cache directory, least recently used entries are removed first. DEFAULT: 20',
+            type = float,
+            metavar = 'CACHE-SIZE',
+            default = 20
+        )
+
     deconv.add_argument(
             '--thread',
             '-t',
-            help = 'Number of thread for counting reads of BAMs. DEFAULT: 1',
+            help = 'Number of thread for counting reads of BAMs and deconvolving the mixed samples. DEFAULT: 1',
             type = int,
             default = 1
         )
@@ -344,6 +494,36 @@ def opts():
             default = './'
         )
 
+    convert = subpar.add_parser('convert', help='Convert tab-separated profiles (read counts profiles or signature matrices) \
+            into the binary columnar format, which is memory-mapped by the findctsps and deconvolution steps.')
+
+    convert.add_argument(
+            '--profile',
+            '-f',
+            help = 'Tab-separated profile files which need to be converted, such as data/*_signature_matrix.xls',
+            type = str,
+            nargs = '+',
+            metavar = 'PROFILE'
+        )
+
+    convert.add_argument(
+            '--lib-strategy',
+            '-l',
+            help = 'A string indicating the type of the profile measurements. DEFAULT: detected from the header, \
+                    ATAC-Seq if the first three columns are chrom, start and end',
+            choices = ['ATAC-Seq', 'RNA-Seq', 'Microarray'],
+            default = None
+        )
+
+    convert.add_argument(
+            '--outdir',
+            '-o',
+            help = 'If specified all output files will be written to that directory. DEFAULT: the current working directory',
+            type = str,
+            metavar = 'OUTDIR',
+            default = './'
+        )
+
 
     if len(sys.argv) <= 1: sys.exit(parser.print_help())
     args = parser.parse_args()
@@ -352,9 +532,10 @@ def opts():
         if sys.argv[-1] == 'findctsps': sys.exit(findctsps.print_help())
         if sys.argv[-1] == 'deconvolution': sys.exit(deconv.print_help())
         if sys.argv[-1] == 'simulation': sys.exit(simulate.print_help())
+        if sys.argv[-1] == 'convert': sys.exit(convert.print_help())
     
-    args.sub_parser, args.preprocess, args.findctsps, args.deconv, args.simulate = \
-            sys.argv[1], preprocess, findctsps, deconv, simulate
+    args.sub_parser, args.preprocess, args.findctsps, args.deconv, args.simulate, args.convert = \
+            sys.argv[1], preprocess, findctsps, deconv, simulate, convert
     return args
 
 if __name__ == '__main__':
@@ -23,93 +23,173 @@ LOGS = log_infos() # logging informative
 
 #--------------------------------------------------------
 
-def extract_infos(profile, phenotypes, qvalues, fields, pi_score=1.0, exp_ratio=0.33):
+def score_peaks(profile, qvalues, fields, pi_score=1.0, exp_ratio=0.33, dtype=np.float64):
     '''
-    extract key infos for flow-up analysis
+    score peaks by q-value and fold change of the top cell type, all peaks are scored together by masked operations
     :param profile: [pd.DataFrame] pure sample profile
-    :param phenotypes: [pd.DataFrame] Phenotype classes file
     :param qvalues: [pd.DataFrame] q-value of cell type specific peaks
     :param fields: [list] target data field
     :param pi_score: [float] Pi-score value to descide cell type-specific peaks, default: 1.0
     :param exp_ratio: [float] peak expression concentration ratio, default: 0.33
-    :return: infos [pd.DataFrame]
+    :param dtype: [np.dtype] float type of the scoring arrays, default: np.float64
+    :return: infos [pd.DataFrame] peaks passing the expression ratio and Pi-score
     
     '''
-    (nrows, ncols), fold_changes, bool_lst = profile[fields].shape, [], []
-    min_qvals = np.min(qvalues, axis=1)
+    values    = np.asarray(profile[fields].values, dtype=dtype)
+    min_qvals = np.min(qvalues.values, axis=1)
     max_index = np.argmin(qvalues.values, axis=1)
     
-    for idx, row in enumerate(profile[fields].values):
-        index = max_index[idx]
-        topv, others = row[index], np.delete(row, index)
-        fchang = np.log2(topv / np.mean(others))
-        fold_changes.append(fchang)
-        bool_lst.append(topv * exp_ratio > np.max(others))
+    others = np.ones(values.shape, dtype=bool)
+    others[np.arange(values.shape[0]), max_index] = False
+    topv = values[np.arange(values.shape[0]), max_index]
+    fold_changes = np.log2(topv / np.mean(values, axis=1, where=others))
+    bool_lst = topv * exp_ratio > np.max(values, axis=1, where=others, initial=-np.inf)
     
     infos = pd.DataFrame(
-            np.array([-np.log10(min_qvals.values), max_index, fold_changes, bool_lst]).T,
+            np.column_stack([-np.log10(min_qvals), max_index, fold_changes, bool_lst]).astype(np.float64),
             columns = ['Qvalue', 'TopIndex', 'FoldChange', 'Bool'],
             index = profile.index)
     
     profile = pd.concat([profile, infos], axis=1)
     profile = profile.loc[~(profile.Bool == 1)]
     profile['Score'] = profile.Qvalue * profile.FoldChange
-    profile = profile[profile.Score >= pi_score ]
+    return profile[profile.Score >= pi_score ]
+
+def extract_infos(profile, phenotypes, qvalues, fields, pi_score=1.0, exp_ratio=0.33, dtype=np.float64):
+    '''
+    extract key infos for flow-up analysis
+    :param profile: [pd.DataFrame] pure sample profile
+    :param phenotypes: [pd.DataFrame] Phenotype classes file
+    :param qvalues: [pd.DataFrame] q-value of cell type specific peaks
+    :param fields: [list] target data field
+    :param pi_score: [float] Pi-score value to descide cell type-specific peaks, default: 1.0
+    :param exp_ratio: [float] peak expression concentration ratio, default: 0.33
+    :param dtype: [np.dtype] float type of the scoring arrays, default: np.float64
+    :return: infos [pd.DataFrame]
+    
+    '''
+    profile = score_peaks(profile, qvalues, fields, pi_score, exp_ratio, dtype)
     LOGS.info('{} cell type specific peaks across {} cell types were identified'.format(profile.shape[0], phenotypes.shape[0]))
 
     return profile
 
+def rank_peaks(profile, max_group_size=None):
+    '''
+    rank cell type specific peaks once, peaks are sorted by score and grouped by top cell type in the order of first
+    appearance, so the peaks filtered with any group size are a prefix of each group
+    :param profile: [pd.DataFrame] pure sample profile and supplementary information, including top index and specific score
+    :param max_group_size: [int] only keep the top max_group_size peaks of each group, default: None (keep all)
+    :return: ranked [pd.DataFrame] ranked peaks, ranks [np.array] rank of each peak inside its group
+    
+    '''
+    profile = profile.sort_values(by=['Score'], ascending=False, kind='mergesort')
+    order   = pd.Categorical(profile.TopIndex, categories=profile.TopIndex.unique()).codes
+    ranks   = profile.groupby('TopIndex', sort=False).cumcount().values
+    keep    = np.lexsort((ranks, order))
+    keep    = keep[ranks[keep] < max_group_size] if max_group_size is not None else keep
+    return profile.iloc[keep], ranks[keep]
+
+def condition_number(sub_profile, phenotypes):
+    '''
+    condition number of the standardized profile of cell type specific peaks
+    :param sub_profile: [pd.DataFrame] profile of cell type specific peaks
+    :param phenotypes: [pd.DataFrame] Phenotype classes file
+    :return: cond_val [float]
+    
+    '''
+    tmp_data  = sub_profile[phenotypes.index]
+    tmp_data -= np.mean(tmp_data, axis=0)
+    tmp_data  = tmp_data.divide(np.std(tmp_data, axis=0), axis=1)
+    U, S, V   = linalg.svd(tmp_data, full_matrices=False)
+    return np.max(abs(S)) / np.min(abs(S))
+
+def gram_condition_numbers(values, ranks, group_sizes):
+    '''
+    condition numbers of the standardized prefixes of all group sizes at once. The standardized matrix Z of each group
+    size has singular values sqrt(n * eig(corr)), so cumulative sums of rows and outer products over ranks give every
+    correlation matrix, whose eigenvalues are computed in one batch
+    :param values: [np.array] ranked peaks x cell types
+    :param ranks: [np.array] rank of each peak inside its group
+    :param group_sizes: [list] group sizes
+    :return: conds [np.array] condition numbers, NaN if not positive definite
+    
+    '''
+    values = values - np.mean(values, axis=0) # shift invariant, limits cancellation
+    nranks = max(group_sizes)
+    sums, outers, counts = np.zeros((nranks, values.shape[1])), np.zeros((nranks, ) + (values.shape[1], ) * 2), np.zeros(nranks)
+    np.add.at(sums, ranks, values)
+    np.add.at(outers, ranks, values[:, :, None] * values[:, None, :])
+    np.add.at(counts, ranks, 1)
+    
+    index = np.asarray(group_sizes) - 1
+    sums, outers, counts = np.cumsum(sums, axis=0)[index], np.cumsum(outers, axis=0)[index], np.cumsum(counts)[index]
+    means  = sums / counts[:, None]
+    covars = outers / counts[:, None, None] - means[:, :, None] * means[:, None, :]
+    stds   = np.sqrt(np.diagonal(covars, axis1=1, axis2=2))
+    eigs   = np.linalg.eigvalsh(covars / stds[:, :, None] / stds[:, None, :])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        conds = np.sqrt(eigs[:, -1] / eigs[:, 0])
+    conds[~(eigs[:, 0] > 0)] = np.nan
+    return conds
+
 def filter_peaks(profile, phenotypes, group_size):
     '''
     filter high confidence cell type specific peaks
     :param profile: [pd.DataFrame] pure sample profile and supplementary information, including q-value, top index, foldchange and specific score
     :param phenotypes: [pd.DataFrame] Phenotype classes file
-    :param qvalues: [pd.DataFrame] q-value of cell type specific peaks
     :param group_size: [int] number of cell type specific peaks to consider for each phenotypes
     :return: sub_profile [pd.DataFrame]
     
     '''
-    sub_profile, cellnames = None, phenotypes.index
-    profile = profile.sort_values(by=['Score'], ascending=False)
-     
-    for idx, sample_idx in enumerate(profile.TopIndex.unique()):
-        sub_tmp  = profile[(profile.TopIndex == sample_idx)]
-        min_size = min(group_size, sub_tmp.shape[0])
-        sub_tmp  = sub_tmp.iloc[0 : min_size]
-        sub_profile = pd.concat([sub_profile, sub_tmp]) if idx else sub_tmp
-    
-    tmp_data  = sub_profile[phenotypes.index]
-    tmp_data -= np.mean(tmp_data, axis=0)
-    tmp_data  = tmp_data.divide(np.std(tmp_data, axis=0), axis=1)
-    U, S, V   = linalg.svd(tmp_data, full_matrices=False)
-    cond_val  = np.max(abs(S)) / np.min(abs(S))
-    return sub_profile, cond_val
+    sub_profile = rank_peaks(profile, group_size)[0]
+    return sub_profile, condition_number(sub_profile, phenotypes)
 
-def optimize_peaks(profile, phenotypes, qvalues, min_group_size, max_group_size, pi_score=1.0, exp_ratio=0.33):
+def select_group_size(profile, phenotypes, min_group_size, max_group_size):
     '''
-    optimize cell type peaks
-    :param profile: [pd.DataFrame] pure sample profile
+    the group size with the smallest condition number is searched from max_group_size down to min_group_size. Peaks
+    are ranked once and each group size takes a prefix of every group, condition numbers of all sizes are screened
+    together by gram_condition_numbers and confirmed by SVD when two are too close to call
+    :param profile: [pd.DataFrame] scored peaks returned by extract_infos
     :param phenotypes: [pd.DataFrame] Phenotype classes file
-    :param qvalues: [pd.DataFrame] q-value of cell type specific peaks
     :param min_group_size: [int] minimum number of cell type specific peaks to consider for each phenotypes
     :param max_group_size: [int] maximum number of cell type specific peaks to consider for each phenotypes
-    :param pi_score: [float] Pi-score value to descide cell type-specific peaks, default: 1.0
-    :param exp_ratio: [float] peak expression concentration ratio, default: 0.33
     :return: signature_mat [pd.DataFrame]
     
     '''
     fields, cond_pre, size_pre = phenotypes.index, sys.float_info.max, 0
-    profile = extract_infos(profile, phenotypes, qvalues, fields, pi_score, exp_ratio)
     group_size = range(min_group_size, max_group_size + 1)[::-1]
-    del qvalues
 
-    profile_bak = profile
-    for idx, size in enumerate(group_size):
-        sub_profile, cond_cur = filter_peaks(profile, phenotypes, size)
+    ranked, ranks = rank_peaks(profile, max_group_size)
+    conds = gram_condition_numbers(ranked[fields].values.astype(np.float64), ranks, list(group_size)) if len(group_size) else []
+    exact = {}
+    exact_cond = lambda size : exact[size] if size in exact else exact.setdefault(size, condition_number(ranked[ranks < size], phenotypes))
+    
+    for size, cond_cur in zip(group_size, conds):
+        if not np.isfinite(cond_cur) or abs(cond_cur - cond_pre) <= 1e-6 * max(cond_cur, cond_pre):
+            cond_cur = exact_cond(size)
+            cond_pre = exact_cond(size_pre) if size_pre else cond_pre
         if cond_cur > cond_pre: continue
-        profile, cond_pre, size_pre = sub_profile, cond_cur, size
+        cond_pre, size_pre = cond_cur, size
     
-    sub_profile, cond_cur = filter_peaks(profile, phenotypes, size_pre)
+    sub_profile, cond_cur = ranked[ranks < size_pre], exact_cond(size_pre)
     LOGS.info('Group size of each phenotype is {}, matrix condition number is {}'.format(size_pre, cond_cur))
     sub_profile = sub_profile[['chrom', 'start', 'end'] + phenotypes.index.tolist()]
-    return sub_profile, profile_bak
+    return sub_profile, profile
+
+def optimize_peaks(profile, phenotypes, qvalues, min_group_size, max_group_size, pi_score=1.0, exp_ratio=0.33, dtype=np.float64):
+    '''
+    optimize cell type peaks, peaks are scored by extract_infos and the group size is chosen by select_group_size
+    :param profile: [pd.DataFrame] pure sample profile
+    :param phenotypes: [pd.DataFrame] Phenotype classes file
+    :param qvalues: [pd.DataFrame] q-value of cell type specific peaks
+    :param min_group_size: [int] minimum number of cell type specific peaks to consider for each phenotypes
+    :param max_group_size: [int] maximum number of cell type specific peaks to consider for each phenotypes
+    :param pi_score: [float] Pi-score value to descide cell type-specific peaks, default: 1.0
+    :param exp_ratio: [float] peak expression concentration ratio, default: 0.33
+    :param dtype: [np.dtype] float type of the scoring arrays, default: np.float64
+    :return: signature_mat [pd.DataFrame]
+    
+    '''
+    profile = extract_infos(profile, phenotypes, qvalues, phenotypes.index, pi_score, exp_ratio, dtype)
+    del qvalues
+    return select_group_size(profile, phenotypes, min_group_size, max_group_size)
@@ -9,8 +9,9 @@
 #--------------------------------------------------------
 # load own modules
 
-from modules.utils    import *
-from modules.opt_cmds import opts
+from modules.utils             import *
+from modules.opt_cmds          import opts
+from modules.normalize_methods import CHUNKED_NORMS, STREAMED_NORMS
 
 #--------------------------------------------------------
 # global setting
@@ -129,6 +130,10 @@ def findctsps():
             [ARGS.profile, ARGS.phenotype]
     basic_parameters(ARGS.findctsps, cmds, values, [0, 1])
     ARGS.merge_replicates = 'mean'
+    if ARGS.chunk_size < 0:
+        die(ARGS.findctsps, '--chunk-size must be a positive number of peaks, exiting......')
+    if ARGS.chunk_size and ARGS.norm not in CHUNKED_NORMS:
+        die(ARGS.findctsps, '--chunk-size supports {} normalization, exiting......'.format(' and '.join(CHUNKED_NORMS)))
     return 0
 
 def deconvolution():
@@ -144,8 +149,18 @@ def deconvolution():
         die(ARGS.deconv, '--format/-f name must be assigned when --mixture/-m exist, exiting......')
     if ARGS.format == 'BAM':
         ARGS.infos, ARGS.mapq = read_snyaml(ARGS.mixture, ref=False), 10
+        if not is_regions_profile(ARGS.pure):
+            die(ARGS.deconv, '--pure/-p must start with chrom, start and end columns of peaks when --format/-f is BAM, exiting......')
+    
+    if ARGS.iterations < 1:
+        die(ARGS.deconv, '--iterations must be a positive integer, exiting......')
+    if ARGS.chunk_size < 0:
+        die(ARGS.deconv, '--chunk-size must be a positive number of samples, exiting......')
+    if ARGS.chunk_size and ARGS.norm and ARGS.norm not in STREAMED_NORMS:
+        die(ARGS.deconv, '--chunk-size supports {} normalization, exiting......'.format(' and '.join(STREAMED_NORMS)))
     
     ARGS.pvalue = True if ARGS.pvalue == 'TRUE' else False
+    ARGS.early_stop = True if ARGS.early_stop == 'TRUE' else False
     return 0
 
 def simulate():
@@ -171,6 +186,19 @@ def simulate():
         die(ARGS.simulate, '--mixture/-m assigned each value must be greater than 0, exiting......')
     return 0
 
+def convert():
+    '''
+    check whether the parameters of convert step are legal
+    :return: 0
+    
+    '''
+    if not ARGS.profile:
+        die(ARGS.convert, 'Too few input parameters, --profile/-f must has input, exiting......')
+    nonexists = doublecheck_files(ARGS.profile)[1]
+    if nonexists:
+        die(ARGS.convert, 'File cannot be detected of --profile/-f option: {}'.format(', '.join(nonexists)))
+    return 0
+
 def check_platform():
     '''
     check unix platform or not
@@ -190,13 +218,13 @@ def parse_opts():
     '''
     global ARGS
     ARGS = opts()
-    funcs, values = [preprocess, findctsps, deconvolution, simulate], \
-                    ['preprocess', 'findctsps', 'deconvolution', 'simulation']
+    funcs, values = [preprocess, findctsps, deconvolution, simulate, convert], \
+                    ['preprocess', 'findctsps', 'deconvolution', 'simulation', 'convert']
     
     if funcs == preprocess: check_platform()
     funcs[values.index(ARGS.sub_parser)]()
     
     outdir = os.path.join(ARGS.outdir, ARGS.sub_parser)
     status, ARGS.outdir = create_dirs(outdir), outdir
-    [ARGS.__delattr__(attr) for attr in ['preprocess', 'findctsps', 'deconv', 'simulate']]
+    [ARGS.__delattr__(attr) for attr in ['preprocess', 'findctsps', 'deconv', 'simulate', 'convert']]
     return ARGS
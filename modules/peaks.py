@@ -10,34 +10,32 @@
 # load python modules
 
 from scipy import io
+from itertools import islice
 
 #-----------------------------------------------------
 # load own modules
 
-from modules.utils import *
+from modules.cache import *
 
 #-----------------------------------------------------
 # global setting
 
 LOGS = log_infos()
-
-if sys.platform == 'win32':
-	pass
-else:
-	from bx.intervals.intersection import Intersecter, Interval
+BLACKLISTS = {} # blacklist intervals cached by file path
 
 #----------------------------------------------------
-def select_peaks(peakfil, merged_fp, cut_qval=2, cellname=None):
+def select_peaks(peakfil, cut_qval=2, cellname=None, blacklist=None):
     '''
     filter out weak signal peaks, and then adjust to the uniform width if uniform=True
     :param peakfil  : [str/file] enriched regions called by MACS2
-    :param merged_fp: [hanlde] file handler
     :param cut_pval : [float] critical qvalue between weak and stringent peaks, defaullt: qvalue = 0.01 (-log10(q)=2)
     :param cellname : [str] cell name, default: None
-    :return: merged_fp [handler] merged file handler and peaks [pd.DataFrame]
+    :param blacklist: [dict] blacklist intervals returned by load_blacklist, default: None
+    :return: peaks [pd.DataFrame] sorted stringent peaks
       
     '''
     peaks = pd.read_csv(peakfil, sep='\t', names=NARROWS_NAMES)
+    if blacklist is not None: peaks = filter_blacklist(peaks, blacklist)
     peaks = peaks[peaks['qValue'] >= cut_qval]
     peaks = peaks[peaks['chrom'].isin(CHROMS)]
     
@@ -46,152 +44,245 @@ def select_peaks(peakfil, merged_fp, cut_qval=2, cellname=None):
     peaks['start'], peaks['end'] = summits_pos - 250, summits_pos + 250
     
     peaks = peaks.sort_values(by=['chrom', 'start', 'end'], ascending=True)
-    peaks.to_csv(merged_fp, mode='a', sep='\t', header=False, index=False)
-    return merged_fp, peaks
+    return peaks
+
+def compact_peaks(peaks, score='foldChange'):
+    '''
+    split sorted peaks into compact per-chromosome arrays, which are cheap to send back from child processes
+    :param peaks: [pd.DataFrame] sorted peaks of one sample
+    :param score: [str] column used to rank overlapping peaks, default: foldChange
+    :return: table [dict] chromosome -> (starts, ends, scores) [np.array]
+    
+    '''
+    starts, ends = peaks['start'].values.astype(np.int32), peaks['end'].values.astype(np.int32)
+    scores, table = peaks[score].values.astype(float), {}
+    for chrom, index in peaks.groupby('chrom', sort=False).indices.items():
+        table[chrom] = (starts[index], ends[index], scores[index])
+    return table
 
 def single_read_peaks(tasks, kargs):
     '''
     single-process filters peaks according to preset conditions
     :param tasks: [list] the amount of tasks that a single-process needs to perform
     :param kargs: [dict] other param infos, including cut_pval, cut_qval and blacklist (blacklist file path)
-    :rerurn: [str] temp_path
+    :rerurn: peak_tables [list] sorted per-chromosome peak arrays of each sample
     
     '''
-    merged_file = create_tmp_files(mode='a')[0]
+    blacklist, peak_tables = load_blacklist(kargs.blacklist), []
     for tk in tasks:
-        peak_fil = filter_blacklist(tk, kargs.blacklist)
-        cellname = kargs.infos[kargs.infos['PEAK'] == tk]['CELL'].values.tolist()[0]
-        merged_file = select_peaks(
-                peak_fil               ,
-                merged_file            ,
-                cut_qval = kargs.qvalue,
-                cellname = cellname    ,
-            )[0] # select stringent peaks
-    merged_file.close()
-    return [ merged_file.name ]
-
-def filter_blacklist(peak_file, blacklist):
+        key = cache_key('peaks', file_signature(tk), kargs.qvalue, file_signature(kargs.blacklist))
+        table = cache_load(kargs.cache_dir, key)
+        if table is None:
+            cellname = kargs.infos[kargs.infos['PEAK'] == tk]['CELL'].values.tolist()[0]
+            peaks = select_peaks(
+                    tk                     ,
+                    cut_qval = kargs.qvalue,
+                    cellname = cellname    ,
+                    blacklist = blacklist
+                ) # select stringent peaks
+            table = compact_peaks(peaks)
+            cache_save(kargs.cache_dir, key, table)
+        peak_tables.append(table)
+    return peak_tables
+
+def merge_two_runs(left, right):
+    '''
+    stable merge of two sorted runs by binary search of their keys, on equal keys the left run comes first
+    :param left: [tuple] keys, starts, ends and scores [np.array] of a run sorted by keys
+    :param right: [tuple] keys, starts, ends and scores [np.array] of a run sorted by keys
+    :return: [tuple] merged keys, starts, ends and scores
+    
+    '''
+    lpos = np.arange(len(left[0])) + np.searchsorted(right[0], left[0], side='left')
+    rpos = np.arange(len(right[0])) + np.searchsorted(left[0], right[0], side='right')
+    merged = []
+    for larr, rarr in zip(left, right):
+        arr = np.empty(len(larr) + len(rarr), dtype=np.result_type(larr, rarr))
+        arr[lpos], arr[rpos] = larr, rarr
+        merged.append(arr)
+    return tuple(merged)
+
+def merge_sorted_peaks(peak_tables):
+    '''
+    k-way merge of sorted peak tables chromosome by chromosome. Neighbouring runs of the samples are merged in 
+    pairs by binary search until one is left (n log k), peaks with the same start and end keep the sample order
+    :param peak_tables: [list] per-chromosome peak arrays of each sample, returned by compact_peaks
+    :return: generator of (chrom, starts, ends, scores) sorted by start and end
+    
+    '''
+    for chrom in CHROMS:
+        runs = [ table[chrom] for table in peak_tables if chrom in table ]
+        if not runs: continue
+        width = max([ int(ends.max()) + 1 for starts, ends, scores in runs if len(ends) ] + [1])
+        runs  = [ (starts.astype(np.int64) * width + ends, starts, ends, scores) for starts, ends, scores in runs ]
+        while len(runs) > 1:
+            runs = [ merge_two_runs(*runs[idx : idx + 2]) if idx + 1 < len(runs) else runs[idx] for idx in range(0, len(runs), 2) ]
+        yield (chrom, ) + runs[0][1 : ]
+
+def load_blacklist(blacklist):
+    '''
+    load blacklist regions into sorted and merged per-chromosome arrays, only parsed once per process
+    :param blacklist: [str/file] blacklist file which download from ENCODE
+    :return: intervals [dict] chromosome -> (starts [np.array], ends [np.array])
+    
+    '''
+    if blacklist in BLACKLISTS: return BLACKLISTS[blacklist]
+    regions = pd.read_csv(blacklist, sep='\t', header=None, usecols=[0, 1, 2], names=['chrom', 'start', 'end'])
+    regions, intervals = regions.sort_values(by=['chrom', 'start', 'end']), {}
+    
+    for chrom, sub in regions.groupby('chrom', sort=False):
+        starts, ends = sub['start'].values, sub['end'].values
+        newrun = np.append(True, starts[1 : ] > np.maximum.accumulate(ends)[ : -1])
+        heads  = np.where(newrun)[0]
+        intervals[chrom] = (starts[heads], np.maximum.reduceat(ends, heads))
+    BLACKLISTS[blacklist] = intervals
+    return intervals
+
+def filter_blacklist(peaks, blacklist):
     '''
     filter out peaks which in the blacklist
-    :param peak_file: [str/file] merged temporary file
-    :param blacklist: [str] blacklist file which download from ENCODE
-    :return: non-blacklist peak file
+    :param peaks: [pd.DataFrame] peaks of one sample, which contains chromosomes start and end
+    :param blacklist: [dict] blacklist intervals returned by load_blacklist
+    :return: non-blacklist peaks [pd.DataFrame]
+    
+    '''
+    flags = np.zeros(peaks.shape[0], dtype=bool)
+    starts, ends = peaks['start'].values, peaks['end'].values
+    for chrom, index in peaks.groupby('chrom').indices.items():
+        if chrom not in blacklist: continue
+        bl_starts, bl_ends = blacklist[chrom]
+        pos = np.searchsorted(bl_ends, starts[index], side='right') # first region ending after peak start
+        pos = np.minimum(pos, bl_ends.size - 1)
+        flags[index] = (bl_ends[pos] > starts[index]) & (bl_starts[pos] < ends[index])
+    return peaks[~flags]
+
+def nonredundant_peaks(starts, ends, scores):
+    '''
+    choose non-overlapping, maximally significant peaks of one sorted chromosome. It walks the same chain as
+    the pairwise greedy scan: the kept peak is replaced by the first overlapping peak with a higher score,
+    otherwise it is written out and the next non-overlapping peak is kept
+    :param starts: [np.array] peak starts sorted in ascending order
+    :param ends: [np.array] peak ends
+    :param scores: [np.array] peak scores
+    :return: keep [np.array] indices of non-redundant peaks
     
     '''
-    peak_file = decomp_gzfile(peak_file)[0]
-    noblacklist = create_tmp_files('.no_blacklist')[0].name
+    nrows = starts.size
+    breaks  = np.maximum(np.searchsorted(starts, ends, side='left'), np.arange(1, nrows + 1))
+    upgrade = np.full(nrows, nrows)
+    active, step = np.arange(nrows), 1
+    while active.size: # first overlapping peak with a higher score
+        cand   = active + step
+        inside = cand < breaks[active]
+        active, cand = active[inside], cand[inside]
+        better = scores[cand] > scores[active]
+        upgrade[active[better]] = cand[better]
+        active, step = active[~better], step + 1
     
-    bedtools = pkg_resources.resource_filename("DeconPeaker", "sub_tools/bedtools")
-    cmd = '{} intersect -v -a {} -b {} > {}'.format(
-            bedtools  ,
-            peak_file ,
-            blacklist ,
-            noblacklist
-        )
-    syscmd_run(cmd, rm=peak_file) # remove peaks which in the blacklist
-    return noblacklist
+    replaced = upgrade < nrows
+    jumps  = np.append(np.where(replaced, upgrade, breaks), nrows)
+    onpath = np.zeros(nrows + 1, dtype=bool)
+    onpath[0] = True
+    while True: # pointer doubling, peaks reachable from the first one
+        reached = jumps[onpath]
+        if onpath[reached].all(): break
+        onpath[reached] = True
+        jumps = jumps[jumps]
+    return np.where(onpath[ : -1] & ~replaced)[0]
 
-def find_ovp_lsts(container, idx=6):
+def single_nonredundant_peaks(tasks):
     '''
-    find overlap for two list which have been sorted
-    :param container: [list, list] peak region information
-    :param idx: [int] peak score position, default: 6
-    :return: container
+    single-process chooses non-redundant peaks for a list of chromosomes
+    :param tasks: [list] (chrom, starts, ends, scores) of each chromosome
+    :return: [list] (chrom, starts, ends) of non-redundant peaks
     
     '''
-    lst1, lst2 = container
-    if lst1[0] == lst2[0] and lst2[1] < lst1[2]:
-        flag = 0 if lst2[idx] > lst1[idx] else 1
-        container.pop(flag)
-    return container
+    results = []
+    for chrom, starts, ends, scores in tasks:
+        keep = nonredundant_peaks(starts, ends, scores)
+        results.append((chrom, starts[keep], ends[keep]))
+    return results
 
-def remove_redundant_sorted_peaks(peaks, fp):
+def remove_redundant_sorted_peaks(peaks, fp, score='foldChange'):
     '''
     quickly remove redundant peaks for pandas dataframe
-    :param peaks: [pd.DataFrame] peaks informative
+    :param peaks: [pd.DataFrame] peaks informative, sorted by chromosome, start and end
     :param fp: [handler] file handler which peaks need to be save
+    :param score: [str] column used to rank overlapping peaks, default: foldChange
     :return: non-redundant peak file handler
               
     '''
-    columns, peaks = peaks.columns, peaks.values
-    (nrows, ncols), container = np.shape(peaks), []
-    
-    for idx, peak in enumerate(peaks):
-        container.append(peak)
-        if len(container) / 2 != 1: continue
-        container = find_ovp_lsts(container) 
-
-        if len(container) < 2: continue
-        fp.write('\t'.join(map(str, container[0])) + '\n')
-        container.pop(0)
+    starts, ends, scores, keep = peaks['start'].values, peaks['end'].values, peaks[score].values, [[]]
+    for chrom, index in peaks.groupby('chrom', sort=False).indices.items():
+        keep.append(index[nonredundant_peaks(starts[index], ends[index], scores[index])])
     
-    fp.write('\t'.join(map(str, container[0])) + '\n')
+    peaks.iloc[np.sort(np.concatenate(keep)).astype(int)].to_csv(fp, sep='\t', header=False, index=False)
     return fp
 
-def remove_redundant_peakfile(peakfil, cells, prefix, outdir):
+def remove_redundant_peakfile(peak_tables, cells, prefix, outdir, threads=1):
     '''
     choose a list of non-overlapping peaks by specified strategy
-    :param peakfil: [str/file] path of the peak file
+    :param peak_tables: [list] sorted per-chromosome peak arrays of each sample, returned by mp_read_peaks
     :param cells: [list] unique cell names of pure samples
     :param prefix: [str] prefix name of non-redundant peaks output file
     :param outdir: [str/dir] output directory
+    :param threads: [int] number of processes which chromosomes are splitted across, default: 1
     :return: path of non-overlapping peak file
     
     '''
     tmp_overlap = create_tmp_files('.merged_nonoverlap_peaks.bed')[0]
-    cell_map, container = { cell : idx for idx, cell in enumerate(cells) }, []
-    with open(peakfil, 'rb') as fp_r:
-        for idx, line in enumerate(fp_r):
-            line_sep = line.decode().strip().split('\t')
-            (chrom, start, end), score, cell = line_sep[0 : 3], line_sep[6], line_sep[10]
-            start, end, score = int(start), int(end), float(score)
-            container.append([chrom, start, end, score])
-
-            if len(container) / 2 != 1: continue
-            container = find_ovp_lsts(container, idx=3)
-            if len(container) < 2: continue        
-            tmp_overlap.write('\t'.join(map(str, container[0][0 : -1])) + '\n')
-            container.pop(0)
-    
-    tmp_overlap.write('\t'.join(map(str, container[0][0 : -1])) + '\n')
+    merged = merge_sorted_peaks(peak_tables)
+    while True: # only as many merged chromosomes as processes are held at once
+        chroms = list(islice(merged, max(threads, 1)))
+        if not chroms: break
+        for chrom, starts, ends in multi_process(chroms, single_nonredundant_peaks, min(threads, len(chroms))):
+            pd.DataFrame({'chrom': chrom, 'start': starts, 'end': ends}).to_csv(tmp_overlap, sep='\t', header=False, index=False)
     tmp_overlap.close()
     return tmp_overlap.name
 
 def find_overlap_dataframes(query, hits):
     '''
-    find overlap between sorted query and hits regions
+    find overlap between query and hits regions by binary search on per-chromosome sorted starts
     :param query: [pd.DataFrame] query peaks
     :param hits: [pd.DataFrame] hits regions
-    :return: flags [array]
+    :return: query_idx, hit_idx [np.array] positions of each overlapping pair in query and hits
      
     '''
-    query_idx, hits_labs = [], []
-    tree_hash = { chrom : Intersecter() for chrom in hits.chrom.unique() }
-    null_res  = [ tree_hash[chrom].add_interval(Interval(start, end)) for chrom, start, end in hits.values ]
+    query_idx, hit_idx = [ np.array([], dtype=int) ], [ np.array([], dtype=int) ]
+    qstarts, qends = query['start'].values, query['end'].values
+    hstarts, hends = hits['start'].values, hits['end'].values
+    hit_groups = hits.groupby('chrom').indices
     
-    for idx, line in enumerate(query.values):
-        chrom, start, end = line[0 : 3]
-        overlaps = tree_hash[chrom].find(start, end)
-        if not overlaps: continue
-        for ovp in overlaps:
-            hits_labs.append(chrom + ':' + str(ovp.start) + '-' + str(ovp.end))
-            query_idx.append(idx)
+    for chrom, qindex in query.groupby('chrom').indices.items():
+        if chrom not in hit_groups: continue
+        hindex = hit_groups[chrom][np.argsort(hstarts[hit_groups[chrom]], kind='stable')]
+        sub_starts, sub_ends = hstarts[hindex], hends[hindex]
+        lower  = np.searchsorted(sub_starts, qstarts[qindex] - np.max(sub_ends - sub_starts), side='right')
+        upper  = np.searchsorted(sub_starts, qends[qindex], side='left')
+        counts = np.maximum(upper - lower, 0)
+        
+        qpos = np.repeat(qindex, counts) # candidate pairs, then keep hits ending after the query start
+        hpos = np.arange(counts.sum()) + np.repeat(lower - np.cumsum(counts) + counts, counts)
+        flag = sub_ends[hpos] > qstarts[qpos]
+        query_idx.append(qpos[flag]); hit_idx.append(hindex[hpos[flag]])
     
-    tmp_labels = hits.chrom + ':' + hits.start.astype(str) + '-' +  hits.end.astype(str)
-    hit_indexs = tmp_labels[tmp_labels.isin(hits_labs)].index.values
-    return np.array(query_idx), hit_indexs
+    query_idx, hit_idx = np.concatenate(query_idx), np.concatenate(hit_idx)
+    order = np.lexsort((hit_idx, query_idx))
+    return query_idx[order], hit_idx[order]
 
-def remove_peaks_nearbytss(peakfile, hgfile, offset, downstream=500):
+def load_tss_windows(hgfile, offset, downstream=500, cache_dir=None):
     '''
-    remove peaks which nearby TSS 
-    :param peakfile: [str/file] peak file, which contains chromosomes start and end
+    expand TSS positions into exclusion windows, cached on disk by genome build, offset and downstream distance
     :param hgfile: [str/file] TSS postion file
-    :param offset: [int] peaks falling into [TSS - offset, TSS + offset] need to be removed
+    :param offset: [int] offset distance from TSS
     :param downstream: [int] offset distance of downstream, default: 500
-    :return: non-redundant file
+    :param cache_dir: [str/dir] persistent cache directory, default: None (no cache)
+    :return: tssinfos [pd.DataFrame] chromosomes, start and end of the windows
     
     '''
-    columns  = ['chrom', 'start', 'end']
+    key = cache_key('tss_windows', file_signature(hgfile), offset, downstream)
+    tssinfos = cache_load(cache_dir, key)
+    if tssinfos is not None: return tssinfos
     tssinfos = pd.read_csv(hgfile, sep='\t', header=0)
     
     tssinfos.loc[tssinfos.strand == '+', 'start'] -= offset
@@ -201,31 +292,44 @@ def remove_peaks_nearbytss(peakfile, hgfile, offset, downstream=500):
 
     tssinfos.start, tssinfos.end = tssinfos.start - offset, tssinfos.end + offset
     tssinfos.loc[tssinfos['start'] < 0, 'start'] = 0
+    tssinfos = tssinfos[['chrom', 'start', 'end']]
+    cache_save(cache_dir, key, tssinfos)
+    return tssinfos
 
-    peaks = pd.read_csv(peakfile, sep='\t', names=columns)
-    flagindex = find_overlap_dataframes(peaks, tssinfos[columns])[0]
-    peaks = peaks.drop(flagindex).reset_index(drop=True)
+def remove_peaks_nearbytss(peakfile, hgfile, offset, downstream=500, cache_dir=None):
+    '''
+    remove peaks which nearby TSS 
+    :param peakfile: [str/file] peak file, which contains chromosomes start and end
+    :param hgfile: [str/file] TSS postion file
+    :param offset: [int] peaks falling into [TSS - offset, TSS + offset] need to be removed
+    :param downstream: [int] offset distance of downstream, default: 500
+    :param cache_dir: [str/dir] persistent cache directory of the expanded TSS windows, default: None (no cache)
+    :return: non-redundant file
+    
+    '''
+    tssinfos = load_tss_windows(hgfile, offset, downstream, cache_dir)
+    peaks = pd.read_csv(peakfile, sep='\t', names=['chrom', 'start', 'end'])
+    flagindex = np.unique(find_overlap_dataframes(peaks, tssinfos)[0])
+    peaks = peaks.drop(peaks.index[flagindex]).reset_index(drop=True)
     peaks.to_csv(peakfile, sep='\t', header=False, index=False)
     return peakfile
 
 def mp_read_peaks(peak_files, kargs):
     '''
-    multi-processes to filter peaks, and then write into temporary files
+    multi-processes to filter peaks, each sample is kept as sorted per-chromosome arrays
     :param peak_files: [list] the corresponding peak file for each sample
-    :param kargs: [dict] other param infos, including cut_pval, cut_qval , nth (thread number) and blacklist (blacklist file path)
-    :return: merged_files [str/file] sorted peak file
+    :param kargs: [dict] other param infos, including cut_pval, cut_qval , nth (thread number), blacklist (blacklist file path) and cache_dir
+    :return: peak_tables [list] sorted peak arrays of each sample, merged later by merge_sorted_peaks
      
     '''
     peak_files = list(set(peak_files)) if isinstance(peak_files, list) else [ peak_files ]
-    merged_files = multi_process(
+    task_kargs = slim_args(kargs, 'qvalue', 'blacklist', 'cache_dir')
+    task_kargs.infos = kargs.infos[['PEAK', 'CELL']]
+    peak_tables = multi_process(
             peak_files       , 
             single_read_peaks, 
             kargs.thread     , 
-            kargs = kargs
+            kargs = task_kargs
         )
-    [ catfiles(fil, merged_files[0], rm=fil) for index, fil in enumerate(merged_files) if index > 0 ]
-    merged_sorted = create_tmp_files('.merged_sorted_peaks.bed')[0].name
-    sortfiles(merged_files[0], merged_sorted, rm=merged_files[0]) # quick sort peak file
-    merged_files = merged_sorted
-    return merged_files
-
+    evict_cache(kargs.cache_dir, kargs.cache_size)
+    return peak_tables
@@ -23,7 +23,7 @@ def sim_from_bam(pure_bams, readcnts, kargs):
     sampling reads from BAMs of pure cells
     :param pure_bams: [str/path] bam of pure cells
     :param readcnts: [int] total number of reads after sampling 
-    :param kargs: [dict] total input parameters of simulation step
+    :param kargs: [dict] pure_infos and cellcounts of simulation step
     :return: tmpbams [list/files]
     
     '''
@@ -31,7 +31,7 @@ def sim_from_bam(pure_bams, readcnts, kargs):
     for idx, bam in enumerate(pure_bams):
         bam   = bam[0] if isinstance(bam, np.ndarray) else bam
         infos = kargs.pure_infos[kargs.pure_infos['data'] == bam]
-        cell  = infos['cellname'][0]
+        cell  = infos['cellname'].values[0]
         prob  = readcnts[cell] / float(kargs.cellcounts[cell])
         tmpfp = create_tmp_files('.bam')[0].name
         cmds  = 'samtools view -s {0} -b {1} -@ 4 > {2}'.format(prob, bam, tmpfp)
@@ -81,7 +81,7 @@ def simulate_mixture(kargs):
                     sim_from_bam           ,
                     kargs.thread           , 
                     readcnts = adj_readcnts,
-                    kargs = kargs
+                    kargs = slim_args(kargs, 'pure_infos', 'cellcounts')
                 ) # simulation reads of each cell with fix proportion
         prefix = kargs.prefix + '_' + rowinfos.name
         outdir = os.path.join(kargs.outdir, str(len(adj_readcnts)), '_'.join(adj_readcnts.keys()))		
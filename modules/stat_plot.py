@@ -18,7 +18,8 @@ else:
 import seaborn as sns
 import matplotlib.pyplot as plt
 from itertools import cycle
-from rpy2.robjects import r, pandas2ri
+from scipy.cluster import hierarchy
+from matplotlib.colors import ListedColormap
 
 #-----------------------------------------------------
 # load own modules
@@ -33,30 +34,72 @@ sns.set(color_codes=True)
 
 #-----------------------------------------------------
 
+def blue2red(n):
+    '''
+    blue to red color ramp through purple, as blue2red of the R package colorRamps: trapezoid ramps (table.ramp) 
+    of the blue and red channels centered at 0.2 and 0.8, green is off
+    :param n: [int] number of colors
+    :return: [ListedColormap]
+    
+    '''
+    def table_ramp(mid, sill, base):
+        ramp = np.zeros(n)
+        sill_min = max(1, int(np.round((n - 1) * (mid - sill / 2.))) + 1)
+        sill_max = min(n, int(np.round((n - 1) * (mid + sill / 2.))) + 1)
+        base_min = int(np.round((n - 1) * (mid - base / 2.))) + 1
+        base_max = int(np.round((n - 1) * (mid + base / 2.))) + 1
+        ramp[sill_min - 1 : sill_max] = 1
+        for pos, vals in [
+                (np.arange(base_min, sill_min + 1), np.linspace(0, 1, sill_min - base_min + 1)),
+                (np.arange(sill_max, base_max + 1), np.linspace(1, 0, base_max - sill_max + 1))
+            ]:
+            keep = (pos > 0) & (pos <= n)
+            ramp[pos[keep] - 1] = vals[keep]
+        return ramp
+    return ListedColormap(np.column_stack([table_ramp(0.8, 0.2, 1), np.zeros(n), table_ramp(0.2, 0.2, 1)]))
+
+def reorder_linkage(linkage, weights, decreasing=False):
+    '''
+    order the two branches of every merge by the summed weights of their leaves, as reorder.dendrogram called by 
+    heatmap of R with the row/column means as weights
+    :param linkage: [np.array] linkage matrix of scipy
+    :param weights: [np.array] weight of each leaf
+    :param decreasing: [bool] heavier branches first, default: False
+    :return: linkage [np.array] reordered copy
+    
+    '''
+    linkage, nleaf = linkage.copy(), len(weights)
+    sums = np.append(np.asarray(weights, dtype=float), np.zeros(len(linkage)))
+    for idx, (left, right) in enumerate(linkage[:, : 2].astype(int)):
+        sums[nleaf + idx] = sums[left] + sums[right]
+        if (sums[left] < sums[right]) if decreasing else (sums[left] > sums[right]):
+            linkage[idx, : 2] = right, left
+    return linkage
+
 def cluster_heatmap(df, outfile):
     '''
-    plot cluster heatmap
+    plot cluster heatmap as heatmap of R: rows and columns are clustered by complete linkage of the values, 
+    rows are scaled for the colors only
     :param df: [pd.DataFrame] dataframe of input data
     :param outfile: [str] output graph file name 
     :return: 0
     
     '''
     outfile = outfile if outfile.endswith('.png') else outfile + '.png'
-    r.assign('outfile', outfile)
-    r.assign('df', df)
-
-    r('''
-        options(warn = -1)
-        list.of.packages <- c("colorRamps")
-        new.pkgs <- list.of.packages[!(list.of.packages %in% installed.packages()[, "Package"])]
-        if(length(new.pkgs )) install.packages(new.pkgs)
-        suppressMessages(library(colorRamps, quietly = T))
-        df = as.matrix(df)
-        png(outfile)
-        heatmap(df, col = blue2red(50), margins=c(15, 5), labRow=NA)
-        dev.off()
-    ''')
+    values  = np.asarray(df, dtype=float)
+    row_linkage = reorder_linkage(hierarchy.linkage(values, 'complete'), values.mean(axis=1), decreasing=True) # R draws rows bottom-up
+    col_linkage = reorder_linkage(hierarchy.linkage(values.T, 'complete'), values.mean(axis=0))
     
+    grid = sns.clustermap(
+            df                        ,
+            z_score = 0               ,
+            row_linkage = row_linkage ,
+            col_linkage = col_linkage ,
+            cmap = blue2red(50)       ,
+            yticklabels = False
+        )
+    grid.savefig(outfile)
+    plt.close(grid.fig)
     return 0
 
 def stack_bars(df, outfile, tool='deconPeaker'):
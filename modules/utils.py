@@ -12,19 +12,25 @@
 import os
 import sys
 import pdb
+import json
+import atexit
+import pickle
+import shutil
 import logging
+import argparse
+import tempfile
+import threading
+import multiprocessing
 import numpy as np
 import pandas as pd
 from scipy import stats
 from collections import defaultdict
 from operator    import itemgetter
 from distutils.spawn import find_executable
-from rpy2.robjects import r, pandas2ri
 
 #----------------------------------------------------
 # global setting
 
-pandas2ri.activate()
 pd.options.mode.chained_assignment = None # ignore warning generated by pandas
 np.warnings.filterwarnings("ignore")
 INFOS = defaultdict(lambda : defaultdict())
@@ -32,6 +38,12 @@ NARROWS_NAMES = ['chrom', 'start', 'end', 'name', 'score', \
         'strand', 'foldChange', 'pValue', 'qValue', 'summit2PeakDist']
 UPDATE_NARROW_NAMES = NARROWS_NAMES + ['cellName', 'rawWidth']
 CHROMS = [ 'chr{}'.format(x) for x in range(1, 23) ] 
+BINARY_SUFFIX = '.npprof' # directory suffix of binary columnar profiles
+POOL = {} # process-wide worker pool shared by all multi-process stages
+WORKER_KARGS = {} # keyword arguments of the running multi_process call, loaded once per worker
+SHARED_DIR = '/dev/shm' # memory-backed directory of arrays shared with workers, the temporary directory if it is missing or full
+LOGSCALE_PERCENTILES = [0, 25, 50, 75, 99, 100] # percentiles of all values checked by is_logscale
+LOGSCALE_THRESHOLDS = [0, 1, np.nextafter(1, 2), np.nextafter(2, 3), 100] # values is_logscale compares percentiles with, x <= t as x >= next(t)
 
 #----------------------------------------------------
 
@@ -103,22 +115,269 @@ def split_bins(tasks, nth):
         if end >= length: break
     return sub_tasks
 
+def get_pool(nth):
+    '''
+    get the process-wide worker pool, it is created at the first use and only rebuilt when more workers are requested
+    :param nth: [int] number of workers
+    :return: pool [multiprocessing.Pool]
+    
+    '''
+    if POOL.get('size', 0) < nth:
+        close_pool()
+        POOL['pool'], POOL['size'] = multiprocessing.Pool(nth), nth
+        atexit.register(close_pool)
+    return POOL['pool']
+
+def close_pool():
+    '''
+    close and join the process-wide worker pool
+    :return: 0
+    
+    '''
+    pool = POOL.pop('pool', None)
+    POOL.pop('size', None)
+    if pool is not None: pool.close(); pool.join()
+    return 0
+
+def share_kargs(kargs):
+    '''
+    pickle keyword arguments of a multi_process call once into a temporary file, workers load it only once per call
+    :param kargs: [dict] keyword arguments
+    :return: token [tuple] (call number, pickle file) or None if no keyword arguments
+    
+    '''
+    if not kargs: return None
+    POOL['calls'] = POOL.get('calls', 0) + 1
+    fp = tempfile.NamedTemporaryFile(suffix='.kargs', delete=False)
+    pickle.dump(kargs, fp, protocol=-1); fp.close()
+    return POOL['calls'], fp.name
+
+def run_chunk(task):
+    '''
+    run one chunk of a multi_process call in worker
+    :param task: [tuple] (func, chunk of data list, token of shared keyword arguments)
+    :return: returned results of func
+    
+    '''
+    func, chunk, token = task
+    if token is None: return func(chunk)
+    if token not in WORKER_KARGS:
+        WORKER_KARGS.clear()
+        with open(token[1], 'rb') as fp: WORKER_KARGS[token] = pickle.load(fp)
+    return func(chunk, **WORKER_KARGS[token])
+
+def shared_array(shape, dtype, values=None):
+    '''
+    create an array in a memory-mapped .npy file which workers open in place instead of unpickling a copy, the file
+    is placed in SHARED_DIR if it has room for it
+    :param shape: [tuple] array shape
+    :param dtype: [np.dtype] array type
+    :param values: [np.array] initial values, default: None (zeros)
+    :return: path [str] .npy file, array [np.memmap]
+    
+    '''
+    nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    shmdir = SHARED_DIR if os.path.isdir(SHARED_DIR) and shutil.disk_usage(SHARED_DIR).free > 2 * nbytes else None
+    fp = tempfile.NamedTemporaryFile(suffix='.npy', dir=shmdir, delete=False)
+    fp.close()
+    array = np.lib.format.open_memmap(fp.name, mode='w+', dtype=dtype, shape=shape)
+    if values is not None: array[...] = values
+    return fp.name, array
+
+def run_shared_rows(ranges, row_func=None, values=None, out=None, kargs=None):
+    '''
+    run row_func on row ranges of a shared matrix in worker, results are written into the rows of the shared output
+    :param ranges: [list] (start, end) row ranges
+    :param row_func: function of a list of row blocks returning a list of result blocks
+    :param values: [str] .npy file of the shared input matrix
+    :param out: [str] .npy file of the shared output matrix
+    :param kargs: [dict] keyword arguments of row_func
+    :return: [list] empty, nothing is sent back
+    
+    '''
+    values, out = np.load(values, mmap_mode='r'), np.load(out, mmap_mode='r+')
+    for start, end in ranges:
+        out[start : end] = np.concatenate(row_func([values[start : end]], **kargs))
+    out.flush()
+    return []
+
+def shared_multi_process(values, func, nth, out_cols, task_rows, **kargs):
+    '''
+    multi_process over row blocks of a matrix without pickling them: the matrix and the output buffer are shared
+    with the workers by shared_array, the tasks are only row ranges
+    :param values: [np.array] input matrix
+    :param func: function of a list of row blocks returning a list of result blocks, e.g. marker_lmreg
+    :param nth: processor number
+    :param out_cols: [int] number of columns of the results
+    :param task_rows: [int] number of rows of each task
+    :return: out [np.array] float64 results, rows x out_cols
+    
+    '''
+    ranges = [ (start, min(start + task_rows, values.shape[0])) for start in range(0, values.shape[0], task_rows) ]
+    in_path, in_arr = shared_array(values.shape, values.dtype, values)
+    out_path, out = shared_array((values.shape[0], out_cols), np.float64)
+    try:
+        del in_arr
+        multi_process(ranges, run_shared_rows, nth, row_func=func, values=in_path, out=out_path, kargs=kargs)
+        out = np.array(out)
+    finally:
+        [ os.remove(path) for path in [in_path, out_path] if os.path.exists(path) ]
+    return out
+
+def slim_args(kargs, *fields):
+    '''
+    copy only the needed fields of input parameters, to keep the payload of worker tasks light
+    :param kargs: [argparse.Namespace] input parameters by users
+    :param fields: [str] names of the needed fields
+    :return: [argparse.Namespace]
+    
+    '''
+    return argparse.Namespace(**{ field : getattr(kargs, field) for field in fields })
+
+def p_adjust(pvals, method='BH'):
+    '''
+    adjust pvalues for multiple testing as p.adjust of R, the adjusted values are written back into the input array
+    :param pvals: [np.array] pvalues of any shape, float64 C-contiguous arrays are adjusted in place, NaN is kept and not counted
+    :param method: [str] BH (Benjamini & Hochberg) or BY (Benjamini & Yekutieli), default: BH
+    :return: pvals [np.array] adjusted pvalues
+    
+    '''
+    pvals = np.asarray(pvals, dtype=float)
+    flat  = pvals.reshape(-1)
+    valid = ~np.isnan(flat)
+    pvs   = flat if valid.all() else flat[valid]
+    
+    counts = pvs.size
+    order  = np.argsort(pvs)[::-1] # decreasing pvalues, ties do not change the cumulative minimum
+    scale  = counts / np.arange(counts, 0, -1, dtype=float)
+    if method == 'BY': scale *= np.sum(1.0 / np.arange(1, counts + 1))
+    
+    adjusted = np.minimum.accumulate(pvs[order] * scale)
+    np.minimum(adjusted, 1, out=adjusted)
+    pvs[order] = adjusted
+    if pvs is not flat: flat[valid] = pvs
+    return pvals
+
+def p_adjust_blocks(pvals, workdir, block_size, method='BH'):
+    '''
+    p_adjust of a pvalue array which may be larger than memory, e.g. memory-mapped, only about block_size values are
+    held at once. Blocks are sorted into runs on disk, the runs are merged from the largest pvalues down by value
+    segments of at most block_size values (chosen from strided samples of the runs) to carry the cumulative minimum,
+    and every pvalue is then replaced by the adjusted value of its rank. The result equals p_adjust
+    :param pvals: [np.array/np.memmap] float64 C-contiguous pvalues of any shape without NaN, adjusted in place
+    :param workdir: [str/dir] directory of the temporary run files
+    :param block_size: [int] number of values held in memory at once, raised to sqrt(2 * pvals.size) if smaller
+    :param method: [str] BH (Benjamini & Hochberg) or BY (Benjamini & Yekutieli), default: BH
+    :return: pvals [np.array] adjusted pvalues
+    
+    '''
+    flat, counts = pvals.reshape(-1), pvals.size
+    # at most block_size / 2 runs, otherwise a segment takes only a few values per pass and the merge stalls
+    block_size = max(block_size, int(np.ceil(np.sqrt(2.0 * counts))))
+    if counts <= block_size: return p_adjust(pvals, method)
+    
+    new_npy = lambda name : np.lib.format.open_memmap(os.path.join(workdir, name), mode='w+', dtype=np.float64, shape=(counts, ))
+    runs, sorted_p, adjusted = new_npy('pvalue_runs.npy'), new_npy('pvalue_sorted.npy'), new_npy('pvalue_adjusted.npy')
+    starts = np.arange(0, counts, block_size)
+    ends   = np.minimum(starts + block_size, counts)
+    for start, end in zip(starts, ends):
+        runs[start : end] = np.sort(flat[start : end])
+    
+    # a run has at most stride values above its largest sample not above the pivot, so a segment holds at most
+    # stride * (top + len(runs)) <= block_size values
+    stride  = max(1, block_size // (2 * len(starts)))
+    top     = max(1, block_size // (2 * stride))
+    samples = [ np.array(runs[start : end : stride]) for start, end in zip(starts, ends) ]
+    factor  = np.sum(1.0 / np.arange(1, counts + 1)) if method == 'BY' else 1.0
+    
+    upper, carry = ends.copy(), np.inf
+    while (upper > starts).any():
+        remain = np.concatenate([ sample[: (end - start + stride - 1) // stride] for sample, start, end in zip(samples, starts, upper) ])
+        pivot  = np.partition(remain, remain.size - top - 1)[remain.size - top - 1] if remain.size > top else np.min(remain)
+        lower  = np.array([ start + np.searchsorted(runs[start : end], pivot, 'left') for start, end in zip(starts, upper) ])
+        above  = np.array([ start + np.searchsorted(runs[start : end], pivot, 'right') for start, end in zip(starts, upper) ])
+        
+        base   = np.sum(above - starts) # ranks of the values above the pivot start after base
+        values = np.sort(np.concatenate([ runs[start : end] for start, end in zip(above, upper) ]))
+        scaled = values * (counts / np.arange(base + 1, base + values.size + 1, dtype=float) * factor)
+        scaled = np.minimum.accumulate(np.concatenate([[carry], scaled[::-1]]))
+        carry  = scaled[-1]
+        sorted_p[base : base + values.size], adjusted[base : base + values.size] = values, np.minimum(scaled[: 0 : -1], 1)
+        
+        ties  = base - np.sum(lower - starts) # tied pvalues share the adjusted value of the highest rank
+        carry = min(carry, pivot * (counts / float(base) * factor))
+        sorted_p[base - ties : base], adjusted[base - ties : base] = pivot, min(carry, 1)
+        upper = lower
+    
+    for start in range(0, counts, block_size):
+        block = flat[start : start + block_size]
+        order = np.argsort(block, kind='stable')
+        block[order] = adjusted[np.searchsorted(sorted_p, block[order], 'right') - 1]
+    
+    del runs, sorted_p, adjusted
+    [ os.remove(os.path.join(workdir, name)) for name in ['pvalue_runs.npy', 'pvalue_sorted.npy', 'pvalue_adjusted.npy'] ]
+    return pvals
+
+def sorted_percentile(sorted_rows, q):
+    '''
+    percentiles of all values of an array whose rows are sorted, e.g. memory-mapped sorted columns of a profile,
+    without merging the rows. Order statistics are selected by halving the candidate range of the widest row around
+    a pivot, and interpolated as np.percentile (linear) of the flattened values
+    :param sorted_rows: [np.array/np.memmap] 2D array, each row is sorted ascending
+    :param q: [float/list] percentiles between 0 and 100
+    :return: [float/np.array] percentiles
+    
+    '''
+    nrows, ncols = sorted_rows.shape
+    counts = nrows * ncols
+    
+    def order_stat(kth):
+        lower, upper = np.zeros(nrows, dtype=np.int64), np.full(nrows, ncols, dtype=np.int64)
+        while True:
+            row   = np.argmax(upper - lower)
+            pivot = sorted_rows[row, (lower[row] + upper[row]) // 2]
+            less  = np.array([ np.searchsorted(vals, pivot, 'left') for vals in sorted_rows ])
+            leq   = np.array([ np.searchsorted(vals, pivot, 'right') for vals in sorted_rows ])
+            if np.sum(less) <= kth < np.sum(leq): return np.float64(pivot)
+            if kth < np.sum(less):
+                upper = np.minimum(upper, less)
+            else:
+                lower = np.maximum(lower, leq)
+    
+    virtual = (counts - 1) * (np.asanyarray(q, dtype=float) / 100)
+    results = []
+    for index in np.atleast_1d(virtual):
+        previous = counts - 1 if index >= counts - 1 else int(np.floor(index))
+        prev_val = order_stat(previous)
+        next_val = prev_val if index >= counts - 1 else order_stat(previous + 1)
+        gamma, diff = index - np.floor(index), next_val - prev_val
+        results.append(next_val - diff * (1 - gamma) if gamma >= 0.5 else prev_val + diff * gamma) # as np.percentile
+    return results[0] if np.ndim(virtual) == 0 else np.array(results)
+
 def multi_process(data_lst, func, nth, **kargs):
     '''
-    multiple processing to handle data list
+    multiple processing to handle data list, small chunks are dynamically scheduled on the process-wide pool,
+    at most nth chunks run at the same time
     :param data_lst: data list
     :param func: unified approach to the processing of various processes
     :param nth: processor number
-    :return: tag_infos [list] returned results for all processors
+    :return: tag_infos [list] returned results for all processors, in the order of data list
       
     '''
     if nth > 1:
-        sub_tasks = split_bins(data_lst, nth)
-        pools = __import__('multiprocessing').Pool(nth)
-        _func = __import__('functools').partial(func, **kargs)
-        tag_infos = pools.map(_func, sub_tasks) # multiple processing
-        pools.close(); pools.join()
-        tag_infos = [subline for line in tag_infos for subline in line]
+        data_lst  = data_lst if isinstance(data_lst, list) else list(data_lst)
+        sub_tasks = split_bins(data_lst, min(nth * 4, max(len(data_lst), 1)))
+        pool, token = get_pool(nth), share_kargs(kargs)
+        slots = threading.Semaphore(nth)
+        release = lambda res : slots.release()
+        try:
+            jobs = []
+            for chunk in sub_tasks:
+                slots.acquire()
+                jobs.append(pool.apply_async(run_chunk, ((func, chunk, token), ), callback=release, error_callback=release))
+            tag_infos = [ subline for job in jobs for subline in job.get() ]
+        finally:
+            0 if token is None else os.remove(token[1])
     else:
         tag_infos = func(data_lst, **kargs)
     return tag_infos
@@ -360,43 +619,361 @@ def merged_replicates(profile, phenotype, method='mean'):
     merged_profile = pd.concat([profile[['chrom', 'start', 'end']], merged_profile], axis=1)
     return merged_profile
 
-def is_logscale(X):
+def is_logscale(X, qx=None):
     '''
     check log2 transform or not
-    :param X: [pd.DataFrame] data need to be check
+    :param X: [pd.DataFrame] data need to be check, unused if qx is given
+    :param qx: [np.array] LOGSCALE_PERCENTILES of all values if already known, default: None
     :return: logc [bool]
     
     '''
-    X = X.values.flatten()
-    qx = np.percentile(X, [0, 25, 50, 75, 99, 100])
+    qx = np.percentile(X.values.flatten(), LOGSCALE_PERCENTILES) if qx is None else qx
     logc = qx[4] >= 100 or (qx[5] - qx[0] >= 50 and qx[1] >= 0) or (qx[1] >= 0 and qx[1] <= 1 and qx[3] >= 1 and qx[3] <= 2)
     return (not logc)
 
-def load_profile(tablefiles, lib_strategy):
+def threshold_stats(values, stats=None, thresholds=LOGSCALE_THRESHOLDS):
     '''
-    load profile based on specified library strategy
-    :param tablefiles: [list/files] data file names that need to be loaded
-    :param lib_strategy: [str] a string indicating the type of the profile measurements
-    :return: loaded data [pd.DataFrame]
+    accumulate over blocks of values what decides how their percentiles compare with some thresholds: number, minimum 
+    and maximum of the values, and for each threshold the number of values below it, the largest of them and the 
+    smallest of the others
+    :param values: [np.array] block of values
+    :param stats: [dict] statistics of the previous blocks, default: None
+    :param thresholds: [list] ascending thresholds, default: LOGSCALE_THRESHOLDS
+    :return: stats [dict]
+    
+    '''
+    values = np.asarray(values, dtype=float).ravel()
+    if stats is None:
+        size  = len(thresholds)
+        stats = {
+                'thresholds': thresholds, 'count': 0, 'min': np.inf, 'max': -np.inf, 'below': np.zeros(size, dtype=np.int64),
+                'below_max': np.full(size, -np.inf), 'above_min': np.full(size, np.inf)
+            }
+    if not values.size: return stats
+    stats['count'] += values.size
+    stats['min'], stats['max'] = min(stats['min'], values.min()), max(stats['max'], values.max())
+    for idx, thr in enumerate(stats['thresholds']):
+        below  = values < thr
+        nbelow = np.count_nonzero(below)
+        stats['below'][idx] += nbelow
+        if nbelow: stats['below_max'][idx] = max(stats['below_max'][idx], values[below].max())
+        if nbelow < values.size: stats['above_min'][idx] = min(stats['above_min'][idx], values[~below].min())
+    return stats
+
+def threshold_percentiles(stats, q=LOGSCALE_PERCENTILES):
+    '''
+    stand-ins of the percentiles (linear, as np.percentile) of values streamed by threshold_stats, they compare with 
+    every threshold as the exact percentiles do. The exact percentile is returned if its order statistics are known 
+    (e.g. minimum and maximum), otherwise the largest threshold it reaches, or -inf
+    :param stats: [dict] returned by threshold_stats
+    :param q: [list] percentiles between 0 and 100, default: LOGSCALE_PERCENTILES
+    :return: [np.array] percentiles
+    
+    '''
+    counts, thresholds = stats['count'], np.asarray(stats['thresholds'])
+    known = { 0 : stats['min'], counts - 1 : stats['max'] }
+    known.update({ nbelow - 1 : val for nbelow, val in zip(stats['below'], stats['below_max']) if nbelow > 0 })
+    known.update({ nbelow : val for nbelow, val in zip(stats['below'], stats['above_min']) if nbelow < counts })
     
+    results = []
+    for index in (counts - 1) * (np.asanyarray(q, dtype=float) / 100):
+        previous = counts - 1 if index >= counts - 1 else int(np.floor(index))
+        gamma = index - np.floor(index)
+        following = previous + 1 if gamma and previous < counts - 1 else previous
+        if previous in known and following in known:
+            diff = known[following] - known[previous]
+            results.append(known[following] - diff * (1 - gamma) if gamma >= 0.5 else known[previous] + diff * gamma) # as np.percentile
+        else:
+            reached = thresholds[previous >= stats['below']]
+            results.append(reached[-1] if len(reached) else -np.inf)
+    return np.array(results)
+
+def is_binary_profile(path):
     '''
-    loaded_data, labels, pesudo_infos = [], ['chrom', 'start', 'end'], ['-', 999, 999]
-    tablefiles = tablefiles if isinstance(tablefiles, list) else [tablefiles]    
+    check the profile is written in binary columnar format or not
+    :param path: [str/file] profile path
+    :return: [bool]
     
+    '''
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, 'meta.json'))
+
+def is_regions_profile(fil):
+    '''
+    check the profile starts with chromosome, start and end columns of peaks (ATAC-Seq layout), rather than
+    genes/probes
+    :param fil: [str/file] profile path, binary columnar or tab-separated format
+    :return: [bool]
+    
+    '''
+    if is_binary_profile(fil):
+        with open(os.path.join(fil, 'meta.json')) as fp:
+            return json.load(fp)['layout'] == 'regions'
+    head = pd.read_csv(fil, sep='\t', header=0, nrows=100)
+    if head.shape[1] < 3 or [ str(col).lower() for col in head.columns[0 : 3] ] != ['chrom', 'start', 'end']: return False
+    return all(pd.api.types.is_integer_dtype(head[col]) for col in head.columns[1 : 3])
+
+def read_profile_table(fil, lib_strategy, dtype=None):
+    '''
+    parse tab-separated profile, ATAC-Seq profiles start with chromosome, start and end columns,
+    pseudo coordinates are inserted for genes/probes of RNA-Seq and Microarray profiles
+    :param fil: [str/file] tab-separated profile
+    :param lib_strategy: [str] a string indicating the type of the profile measurements
+    :param dtype: [str/np.dtype] float type the values are parsed into, default: None (inferred by pandas)
+    :return: data [pd.DataFrame]
+    
+    '''
+    labels, pesudo_infos = ['chrom', 'start', 'end'], ['-', 999, 999]
+    header = pd.read_csv(fil, sep='\t', header=0, nrows=0).columns
+    dtypes = { name : dtype for name in header[3 if lib_strategy == 'ATAC-Seq' else 1 : ] } if dtype else None
     if lib_strategy == 'ATAC-Seq':
-        loaded_data = [ pd.read_csv(fil, sep='\t', header=0) for fil in tablefiles ]
+        return pd.read_csv(fil, sep='\t', header=0, dtype=dtypes)
+    
+    data = pd.read_csv(fil, sep='\t', header=0, index_col=0, dtype=dtypes)
+    [ data.insert(idx, value=pesudo_infos[idx], column=name) for idx, name in enumerate(labels) ]
+    return data
+
+def write_binary_profile(profile, outdir, lib_strategy='ATAC-Seq'):
+    '''
+    write profile in binary columnar format: chromosome codes, int32 start/end columns and the values
+    as one contiguous .npy matrix, which is memory-mapped by read_binary_profile
+    :param profile: [pd.DataFrame] profile, first three columns are chromosome, start and end for ATAC-Seq,
+                    otherwise index are genes/probes (pseudo coordinate columns are dropped)
+    :param outdir: [str/dir] output directory, BINARY_SUFFIX is recommended as suffix name
+    :param lib_strategy: [str] a string indicating the type of the profile measurements, default: ATAC-Seq
+    :return: outdir
+    
+    '''
+    mk_dir(outdir)
+    meta = {'version': 1, 'layout': 'regions' if lib_strategy == 'ATAC-Seq' else 'genes'}
+    if meta['layout'] == 'regions':
+        coords, positions = profile.columns[0 : 3].tolist(), np.arange(3, profile.shape[1])
+        chroms = pd.Categorical(profile[coords[0]].astype(str))
+        np.save(os.path.join(outdir, 'chrom.npy'), chroms.codes.astype(np.int16))
+        np.save(os.path.join(outdir, 'start.npy'), profile[coords[1]].values.astype(np.int32))
+        np.save(os.path.join(outdir, 'end.npy'), profile[coords[2]].values.astype(np.int32))
+        meta.update({'coords': coords, 'chroms': chroms.categories.tolist()})
+    else:
+        positions = [ idx for idx, col in enumerate(profile.columns) if col not in ['chrom', 'start', 'end'] ]
+        meta.update({'index': profile.index.tolist(), 'index_name': profile.index.name})
+    
+    meta['columns'] = [ str(col) for col in profile.columns[positions] ]
+    np.save(os.path.join(outdir, 'values.npy'), np.ascontiguousarray(profile.iloc[:, positions].values))
+    with open(os.path.join(outdir, 'meta.json'), 'w') as fp:
+        json.dump(meta, fp)
+    return outdir
+
+def open_binary_profile(path, mmap_mode='r'):
+    '''
+    open binary columnar profile without loading it
+    :param path: [str/dir] binary profile directory
+    :param mmap_mode: [str] memory-map mode of the value matrix, default: r
+    :return: meta [dict] layout, columns and coordinate infos, values [np.memmap] peaks x samples
+    
+    '''
+    with open(os.path.join(path, 'meta.json')) as fp:
+        meta = json.load(fp)
+    meta['path'] = path
+    return meta, np.load(os.path.join(path, 'values.npy'), mmap_mode=mmap_mode)
+
+def binary_profile_frame(meta, rows, values, columns):
+    '''
+    data frame of some rows of a binary columnar profile, coordinates are read from the memory-mapped columns
+    :param meta: [dict] meta infos returned by open_binary_profile
+    :param rows: [np.array] row positions in the binary profile
+    :param values: [np.array] values of the rows, e.g. normalized or merged
+    :param columns: [list] column names of values
+    :return: data [pd.DataFrame] same layout as read_binary_profile
+    
+    '''
+    path = meta['path']
+    if meta['layout'] == 'regions':
+        data = pd.DataFrame(values, columns=columns, index=rows, copy=False)
+        coord_vals = [
+                pd.Categorical.from_codes(np.load(os.path.join(path, 'chrom.npy'), mmap_mode='r')[rows], meta['chroms']),
+                np.load(os.path.join(path, 'start.npy'), mmap_mode='r')[rows],
+                np.load(os.path.join(path, 'end.npy'), mmap_mode='r')[rows]
+            ]
+        [ data.insert(idx, value=vals, column=name) for idx, (name, vals) in enumerate(zip(meta['coords'], coord_vals)) ]
+    else:
+        meta.setdefault('index_array', np.asarray(meta['index'], dtype=object))
+        index = pd.Index(meta['index_array'][rows], name=meta['index_name'])
+        data  = pd.DataFrame(values, columns=columns, index=index, copy=False)
+        [ data.insert(idx, value=val, column=name) for idx, (name, val) in enumerate(zip(['chrom', 'start', 'end'], ['-', 999, 999])) ]
+    return data
+
+def table_to_binary_profile(fil, outdir, lib_strategy='ATAC-Seq', chunk_size=100000):
+    '''
+    convert tab-separated profile into binary columnar format by streaming blocks of rows, so the table is never
+    loaded at once. Values are stored as float64
+    :param fil: [str/file] tab-separated profile
+    :param outdir: [str/dir] output directory, BINARY_SUFFIX is recommended as suffix name
+    :param lib_strategy: [str] a string indicating the type of the profile measurements, default: ATAC-Seq
+    :param chunk_size: [int] number of rows parsed at once, default: 100000
+    :return: outdir
+    
+    '''
+    mk_dir(outdir)
+    regions = lib_strategy == 'ATAC-Seq'
+    header  = pd.read_csv(fil, sep='\t', header=0, nrows=0).columns
+    nrows   = sum(chunk.shape[0] for chunk in pd.read_csv(fil, sep='\t', header=0, usecols=[0], chunksize=chunk_size))
+    meta    = {'version': 1, 'layout': 'regions' if regions else 'genes', 'columns': [ str(col) for col in header[3 if regions else 1 : ] ]}
+    new_npy = lambda name, dtype, shape : np.lib.format.open_memmap(os.path.join(outdir, name), mode='w+', dtype=dtype, shape=shape)
+    
+    values = new_npy('values.npy', np.float64, (nrows, len(meta['columns'])))
+    coords = [ new_npy(name + '.npy', dtype, (nrows, )) for name, dtype in zip(['chrom', 'start', 'end'], [np.int16, np.int32, np.int32]) ] if regions else []
+    chroms, index, start, index_name = {}, [], 0, None
+    for chunk in pd.read_csv(fil, sep='\t', header=0, index_col=None if regions else 0, chunksize=chunk_size):
+        end = start + chunk.shape[0]
+        values[start : end] = chunk.iloc[:, 3 if regions else 0 : ].values
+        if regions:
+            coords[0][start : end] = [ chroms.setdefault(chrom, len(chroms)) for chrom in chunk.iloc[:, 0].astype(str) ]
+            coords[1][start : end] = chunk.iloc[:, 1].values
+            coords[2][start : end] = chunk.iloc[:, 2].values
+        else:
+            index.extend(chunk.index.tolist())
+            index_name = chunk.index.name
+        start = end
+    
+    [ npy.flush() for npy in [values] + coords ]
+    if regions:
+        meta.update({'coords': header[0 : 3].tolist(), 'chroms': list(chroms)})
+    else:
+        meta.update({'index': index, 'index_name': index_name})
+    with open(os.path.join(outdir, 'meta.json'), 'w') as fp:
+        json.dump(meta, fp)
+    return outdir
+
+def read_binary_profile(path, dtype=None):
+    '''
+    load binary columnar profile, the value matrix is memory-mapped copy-on-write instead of parsed
+    :param path: [str/dir] binary profile directory
+    :param dtype: [str/np.dtype] float type of the values, they are only copied if stored as another type, default: None
+    :return: data [pd.DataFrame] same layout as read_profile_table
+    
+    '''
+    meta, values = open_binary_profile(path, mmap_mode='c')
+    values = values.astype(dtype, copy=False) if dtype else values
+    
+    if meta['layout'] == 'regions':
+        data  = pd.DataFrame(values, columns=meta['columns'], copy=False)
+        codes = np.load(os.path.join(path, 'chrom.npy'))
+        coord_vals = [
+                pd.Categorical.from_codes(codes, meta['chroms']),
+                np.load(os.path.join(path, 'start.npy')),
+                np.load(os.path.join(path, 'end.npy'))
+            ]
+        [ data.insert(idx, value=vals, column=name) for idx, (name, vals) in enumerate(zip(meta['coords'], coord_vals)) ]
+    else:
+        index = pd.Index(meta['index'], name=meta['index_name'])
+        data  = pd.DataFrame(values, columns=meta['columns'], index=index, copy=False)
+        [ data.insert(idx, value=val, column=name) for idx, (name, val) in enumerate(zip(['chrom', 'start', 'end'], ['-', 999, 999])) ]
+    return data
+
+def read_profile(fil, lib_strategy, dtype=None):
+    '''
+    parse profile, either binary columnar or tab-separated format
+    :param fil: [str/file] profile path
+    :param lib_strategy: [str] a string indicating the type of the profile measurements
+    :param dtype: [str/np.dtype] float type of the values, default: None (as stored)
+    :return: data [pd.DataFrame]
+    
+    '''
+    return read_binary_profile(fil, dtype) if is_binary_profile(fil) else read_profile_table(fil, lib_strategy, dtype)
+
+def write_profile(profile, outfile, lib_strategy='ATAC-Seq', fmt='TABLE', index=False):
+    '''
+    write profile as tab-separated table or binary columnar format
+    :param profile: [pd.DataFrame] profile
+    :param outfile: [str/file] output file, suffix name is replaced by BINARY_SUFFIX for binary format
+    :param lib_strategy: [str] a string indicating the type of the profile measurements, default: ATAC-Seq
+    :param fmt: [str] TABLE or BINARY, default: TABLE
+    :param index: [bool] write index of tab-separated table or not, default: False
+    :return: outfile [str/file] path of the written profile
+    
+    '''
+    if fmt == 'BINARY':
+        return write_binary_profile(profile, outfile.rsplit('.', 1)[0] + BINARY_SUFFIX, lib_strategy)
+    profile.to_csv(outfile, sep='\t', header=True, index=index)
+    return outfile
+
+def profile_samples(fil, lib_strategy):
+    '''
+    sample names of a profile without loading it
+    :param fil: [str/file] profile path, binary columnar or tab-separated format
+    :param lib_strategy: [str] a string indicating the type of the profile measurements
+    :return: samples [list]
+    
+    '''
+    if is_binary_profile(fil): return open_binary_profile(fil)[0]['columns']
+    return pd.read_csv(fil, sep='\t', header=0, nrows=0).columns[3 if lib_strategy == 'ATAC-Seq' else 1 : ].tolist()
+
+def profile_row_blocks(fil, lib_strategy, block_rows):
+    '''
+    stream blocks of rows of a profile, binary columnar or tab-separated format, missing values are set to 0
+    :param fil: [str/file] profile path
+    :param lib_strategy: [str] a string indicating the type of the profile measurements
+    :param block_rows: [int] number of rows of each block
+    :return: yields keys [pd.Index] peaks (as keyed by intersect) or genes/probes, values [np.array] rows x samples
+    
+    '''
+    if is_binary_profile(fil):
+        meta, values = open_binary_profile(fil)
+        blocks = ( binary_profile_frame(meta, np.arange(start, min(start + block_rows, len(values))), \
+                values[start : start + block_rows], meta['columns']) for start in range(0, len(values), block_rows) )
     else:
-        for fil in tablefiles:
-            df = pd.read_csv(fil, sep='\t', header=0, index_col=0)
-            [ df.insert(idx, value=pesudo_infos[idx], column=name) for idx, name in enumerate(labels) ]
-            loaded_data.append(df)
+        regions = lib_strategy == 'ATAC-Seq'
+        blocks = pd.read_csv(fil, sep='\t', header=0, index_col=None if regions else 0, chunksize=block_rows)
+        blocks = blocks if regions else ( block.reindex(columns=['chrom', 'start', 'end'] + block.columns.tolist()) for block in blocks )
+    
+    for block in blocks:
+        keys = peak_keys(block) if lib_strategy == 'ATAC-Seq' else block.index
+        yield keys, block.iloc[:, 3 : ].fillna(0).values
+
+def detect_lib_layout(fil):
+    '''
+    guess profile layout from the header of tab-separated profile
+    :param fil: [str/file] tab-separated profile
+    :return: lib_strategy [str] ATAC-Seq if the first three columns are chromosome, start and end, otherwise RNA-Seq
+    
+    '''
+    with open(fil) as fp:
+        header = fp.readline().strip('\n').split('\t')
+    coords = [ name.lower() for name in header[0 : 3] ]
+    return 'ATAC-Seq' if coords == ['chrom', 'start', 'end'] else 'RNA-Seq'
+
+def convert_profile(fil, outdir, lib_strategy=None):
+    '''
+    convert tab-separated profile (read counts or signature matrix) into binary columnar format
+    :param fil: [str/file] tab-separated profile
+    :param outdir: [str/dir] output directory
+    :param lib_strategy: [str] a string indicating the type of the profile measurements, detected from header if None
+    :return: path of binary profile
+    
+    '''
+    lib_strategy = lib_strategy if lib_strategy else detect_lib_layout(fil)
+    outfile = os.path.join(outdir, os.path.basename(fil).rsplit('.', 1)[0] + BINARY_SUFFIX)
+    return write_binary_profile(read_profile_table(fil, lib_strategy), outfile, lib_strategy)
+
+def load_profile(tablefiles, lib_strategy, dtype=None):
+    '''
+    load profile based on specified library strategy, binary columnar profiles are memory-mapped
+    :param tablefiles: [list/files] data file names that need to be loaded
+    :param lib_strategy: [str] a string indicating the type of the profile measurements
+    :param dtype: [str/np.dtype] float type of the values, e.g. float32 to halve the memory, default: None (as stored)
+    :return: loaded data [pd.DataFrame]
+    
+    '''
+    tablefiles  = tablefiles if isinstance(tablefiles, list) else [tablefiles]    
+    loaded_data = [ read_profile(fil, lib_strategy, dtype) for fil in tablefiles ]
     
     for idx, data in enumerate(loaded_data):
         fields = data.columns[3 : ]
-        loaded_data[idx][fields] = loaded_data[idx][fields].fillna(0)
+        if data[fields].isnull().values.any():
+            loaded_data[idx][fields] = loaded_data[idx][fields].fillna(0)
         logc = is_logscale(data[fields])
         if logc: loaded_data[idx][fields] = 2 ** data[fields]
-        loaded_data[idx] = loaded_data[idx][~loaded_data[idx].index.duplicated(keep='first')]
+        duplicated = loaded_data[idx].index.duplicated(keep='first')
+        if duplicated.any(): loaded_data[idx] = loaded_data[idx][~duplicated]
     return loaded_data if len(loaded_data) > 1 else loaded_data[0]
 
 def load_phenotypes(phenotypes_file):
@@ -419,6 +996,16 @@ def load_phenotypes(phenotypes_file):
     else:
         return phenotypes
 
+def peak_keys(profile):
+    '''
+    identify peaks by chromosome, start and end (the first three columns), as chrom_start_end
+    :param profile: [pd.DataFrame] profile of peaks
+    :return: keys [pd.Series]
+    
+    '''
+    first3cols = profile.columns[0 : 3]
+    return profile[first3cols[0]].str.cat(profile[first3cols[1 : ]].astype(str), sep='_')
+
 def intersect(mixprofile, sigprofile, lib_strategy):
     '''
     take the intersection of the mixed profile and the pure cell profile peaks/genes/probes
@@ -429,11 +1016,9 @@ def intersect(mixprofile, sigprofile, lib_strategy):
 
     '''
     if lib_strategy == 'ATAC-Seq':
-        mix_first3cols, sig_first3cols = mixprofile.columns[0 : 3], sigprofile.columns[0 : 3]
-        mixprofile.index = mixprofile[mix_first3cols[0]].str.cat(mixprofile[mix_first3cols[1 : ]].astype(str), sep='_')
-        sigprofile.index = sigprofile[sig_first3cols[0]].str.cat(sigprofile[sig_first3cols[1 : ]].astype(str), sep='_')
+        mixprofile.index, sigprofile.index = peak_keys(mixprofile), peak_keys(sigprofile)
     
-    commom_index = set(mixprofile.index) & set(sigprofile.index)
+    commom_index = sigprofile.index.intersection(mixprofile.index)
     mixprofile, sigprofile = mixprofile.loc[commom_index], sigprofile.loc[commom_index]
     return [mixprofile, sigprofile]
 
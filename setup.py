@@ -14,14 +14,11 @@ setup(
     version = '1.1.1',
     packages = find_packages(),
     install_requires=[
-        'bx==0.3.0',
         'matplotlib==3.7.5',
-        'bx-python',
         'numexpr',
         'numpy',
         'pandas',
         'pysam',
-        'rpy2',
         'scipy',
         'seaborn',
         'setuptools',
@@ -35,7 +32,7 @@ setup(
         ],
     },
     package_data = {
-        '': ['data/*', 'extra/*', 'modules/*', '*.r']
+        '': ['data/*', 'extra/*', 'modules/*']
     },
     author = 'Huamei Li',
     author_email = 'li_hua_mei@163.com',